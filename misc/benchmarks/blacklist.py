@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+#
+# Shadow Daemon -- Web Application Firewall
+#
+# Copyright (C) 2014-2022 Hendrik Buchwald <hb@zecure.org>
+#
+# This file is part of Shadow Daemon. Shadow Daemon is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Compares the local blacklist engine with a round-trip to the stand-in server of
+# the tests. Run it from the root of the repository, e.g.,
+#   PYTHONPATH=. python misc/benchmarks/blacklist.py --filters filters.json
+
+import sys
+import json
+import time
+import argparse
+
+import shadowd.connector
+import shadowd.tests.server
+
+
+# A small sample of rules in the style of the shadowd blacklist.
+FILTERS = [
+    {'rule': '<script', 'impact': 12},
+    {'rule': 'javascript:', 'impact': 8},
+    {'rule': 'on(load|error|mouseover|focus)\\s*=', 'impact': 8},
+    {'rule': 'union\\s+(all\\s+)?select', 'impact': 8},
+    {'rule': '\'\\s*(or|and)\\s', 'impact': 4},
+    {'rule': 'sleep\\s*\\(\\s*\\d', 'impact': 6},
+    {'rule': 'information_schema', 'impact': 8},
+    {'rule': '\\.\\./', 'impact': 4},
+    {'rule': '/etc/(passwd|shadow)', 'impact': 8},
+    {'rule': '\\$\\{jndi:', 'impact': 12},
+    {'rule': '(;|\\||`)\\s*(cat|ls|id|wget|curl)\\b', 'impact': 8},
+    {'rule': '<\\?php', 'impact': 8},
+]
+
+def measure(function, requests):
+    latencies = []
+
+    for _ in range(requests):
+        start = time.perf_counter()
+        function()
+        latencies.append(time.perf_counter() - start)
+
+    latencies.sort()
+    return latencies
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the local blacklist engine.')
+    parser.add_argument('--filters', help='JSON file with the blacklist filters')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--fields', type=int, default=20)
+    args = parser.parse_args()
+
+    filters = FILTERS
+    if args.filters:
+        with open(args.filters, 'r') as handler:
+            filters = json.load(handler)
+
+    engine = shadowd.connector.BlacklistEngine(filters)
+    input = shadowd.connector.StaticInput(
+        '127.0.0.1',
+        '/benchmark',
+        '/benchmark',
+        {'GET|foo' + str(index): 'bar' * 10 for index in range(args.fields)}
+    )
+
+    with shadowd.tests.server.StandInServer(unix=False) as server:
+        connection = shadowd.connector.Connection()
+        targets = [
+            ('local', lambda: engine.scan(input.get_input(), 10)),
+            ('remote', lambda: connection.send(input, '127.0.0.1', server.port, 1, 'foo', None)),
+        ]
+
+        for name, function in targets:
+            latencies = measure(function, args.requests)
+
+            print('%-8s p50 %8.1f us   p99 %8.1f us' % (
+                name,
+                latencies[len(latencies) // 2] * 1000000,
+                latencies[int(len(latencies) * 0.99)] * 1000000
+            ))
+
+if __name__ == '__main__':
+    sys.exit(main())
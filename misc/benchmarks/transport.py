@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+#
+# Shadow Daemon -- Web Application Firewall
+#
+# Copyright (C) 2014-2022 Hendrik Buchwald <hb@zecure.org>
+#
+# This file is part of Shadow Daemon. Shadow Daemon is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Compares the latency of checks over TCP and over a Unix domain socket with the
+# stand-in server of the tests. Run it from the root of the repository, e.g.,
+#   PYTHONPATH=. python misc/benchmarks/transport.py
+
+import sys
+import time
+import argparse
+
+import shadowd.connector
+import shadowd.tests.server
+
+
+class BenchmarkInput(shadowd.connector.Input):
+    def __init__(self, fields):
+        self.input = {'GET|foo' + str(index): 'bar' * 10 for index in range(fields)}
+        self.hashes = {}
+
+    def get_client_ip(self):
+        return '127.0.0.1'
+
+    def get_caller(self):
+        return '/benchmark'
+
+    def get_resource(self):
+        return '/benchmark'
+
+class BenchmarkConfig:
+    def __init__(self, options):
+        self.options = options
+
+    def get(self, key, required = False, default = None):
+        return self.options.get(key, default)
+
+def measure(connection, input, host, port, requests):
+    latencies = []
+
+    for _ in range(requests):
+        start = time.perf_counter()
+        connection.send(input, host, port, 1, 'foo', None)
+        latencies.append(time.perf_counter() - start)
+
+    latencies.sort()
+    return latencies
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the transports of the connector.')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--fields', type=int, default=20)
+    args = parser.parse_args()
+
+    input = BenchmarkInput(args.fields)
+
+    with shadowd.tests.server.StandInServer() as server:
+        targets = [
+            ('tcp', {}, '127.0.0.1'),
+            ('tcp+nodelay', {'tcp_nodelay': '1'}, '127.0.0.1'),
+        ]
+
+        if server.unix_path:
+            targets.append(('unix', {}, 'unix:' + server.unix_path))
+
+        for name, options, host in targets:
+            connection = shadowd.connector.Connection(BenchmarkConfig(options))
+            latencies = measure(connection, input, host, server.port, args.requests)
+
+            print('%-12s p50 %8.1f us   p99 %8.1f us' % (
+                name,
+                latencies[len(latencies) // 2] * 1000000,
+                latencies[int(len(latencies) * 0.99)] * 1000000
+            ))
+
+if __name__ == '__main__':
+    sys.exit(main())
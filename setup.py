@@ -32,6 +32,11 @@ setup(
     author_email='hb@zecure.org',
     license='GPLv2',
     packages=['shadowd'],
+    entry_points={
+        'console_scripts': [
+            'shadowd-replay = shadowd.replay:main',
+        ],
+    },
     classifiers=[
         'Development Status :: 5 - Production/Stable',
         'Intended Audience :: System Administrators',
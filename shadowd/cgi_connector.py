@@ -21,7 +21,7 @@ import urllib
 import hashlib
 import http
 
-from .connector import Input, Output, Connector
+from .connector import Input, Output, Connector, UPLOAD_PATHS
 
 
 class InputCGI(Input):
@@ -34,24 +34,22 @@ class InputCGI(Input):
     def get_resource(self):
         return os.environ.get('REQUEST_URI')
 
-    def gather_input(self):
-        # Reset input.
-        self.input = {}
+    def get_host(self):
+        return os.environ.get('HTTP_HOST')
 
+    def iterate_input(self):
         # Save parameters in input.
         form = cgi.FieldStorage()
         for key in form:
-            if isinstance(form[key], list):
-                for index, element in enumerate(form[key]):
-                    if element.filename:
-                        self.input['FILES|' + self.escape_key(key) + '|' + str(index)] = element.filename
-                    else:
-                        self.input[os.environ['REQUEST_METHOD'] + '|' + self.escape_key(key) + '|' + str(index)] = element.value
-            else:
-                if form[key].filename:
-                    self.input['FILES|' + self.escape_key(key)] = form[key].filename
+            elements = form[key] if isinstance(form[key], list) else [form[key]]
+
+            # Uploads and parameters share the indices of the list, so that the paths match the defused form.
+            for path, element in self.iterate_values(self.escape_key(key), elements):
+                if element.filename:
+                    yield ('FILES|' + path, element.filename)
+                    self.add_upload('FILES|' + path, element.file)
                 else:
-                    self.input[os.environ['REQUEST_METHOD'] + '|' + self.escape_key(key)] = form[key].value
+                    yield (os.environ['REQUEST_METHOD'] + '|' + path, element.value)
 
         # Save cookies in input.
         cookie_string = os.environ.get('HTTP_COOKIE')
@@ -60,12 +58,12 @@ class InputCGI(Input):
             cookie.load(cookie_string)
 
             for key in cookie:
-                self.input['COOKIE|' + self.escape_key(key)] = cookie[key].value
+                yield from self.iterate_cookie(key, cookie[key].value)
 
         # Save headers in input.
         for key in os.environ:
             if key[:5] == 'HTTP_':
-                self.input['SERVER|' + self.escape_key(key)] = os.environ[key]
+                yield from self.iterate_header(key, os.environ[key])
 
     def defuse_input(self, threats):
         # Write all parameters to dict.
@@ -99,7 +97,7 @@ class InputCGI(Input):
                 os.environ[key] = ''
             elif path_split[0] == 'COOKIE':
                 cookies[key] = ''
-            elif path_split[0] == 'FILES':
+            elif path_split[0] in UPLOAD_PATHS:
                 # Can't remove file uploads, so request has to be stopped.
                 return False
             else:
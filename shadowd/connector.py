@@ -15,6 +15,7 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import sys
 import time
 import traceback
 import configparser
@@ -24,6 +25,20 @@ import ssl
 import json
 import hmac
 import hashlib
+import random
+import ipaddress
+import threading
+import collections
+import fnmatch
+import io
+import concurrent.futures
+import inspect
+import gzip
+import atexit
+import itertools
+import collections.abc
+import heapq
+import signal
 
 
 SHADOWD_CONNECTOR_VERSION        = '3.0.2-python'
@@ -35,7 +50,77 @@ STATUS_BAD_SIGNATURE             = 3
 STATUS_BAD_JSON                  = 4
 STATUS_ATTACK                    = 5
 STATUS_CRITICAL_ATTACK           = 6
+TCP_FASTOPEN_CONNECT             = getattr(socket, 'TCP_FASTOPEN_CONNECT', 30 if sys.platform.startswith('linux') else None)
+UPLOAD_PATHS                     = ('FILES', 'FILEHASH', 'FILESIZE', 'FILETYPE')
+BENIGN_PATHS                     = ('GET', 'POST', 'COOKIE', 'SERVER', 'JSON', 'FILES', 'DATA')
+UPLOAD_SIGNATURES                = (
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'%PDF-', 'application/pdf'),
+    (b'PK\x03\x04', 'application/zip'),
+    (b'\x1f\x8b', 'application/gzip'),
+    (b'\x7fELF', 'application/x-executable'),
+    (b'MZ', 'application/x-msdownload'),
+    (b'#!', 'text/x-script'),
+    (b'<?php', 'application/x-php'),
+    (b'<?xml', 'application/xml'),
+)
 
+compiled_cache = {}
+compiled_lock = threading.Lock()
+fork_handlers = []
+prefork_handlers = []
+warmup_handlers = []
+
+
+def compile_once(key, factory):
+    # Config values are parsed once per process and then reused by all requests.
+    try:
+        return compiled_cache[key]
+    except KeyError:
+        with compiled_lock:
+            if key not in compiled_cache:
+                compiled_cache[key] = factory()
+
+            return compiled_cache[key]
+
+def load_file_once(file, factory):
+    # Files are only parsed again if they were modified.
+    return compile_once((factory, file, os.stat(file).st_mtime), lambda: factory(file))
+
+def register_fork_handler(handler, prepare = None):
+    fork_handlers.append(handler)
+
+    if prepare is not None:
+        prefork_handlers.append(prepare)
+
+def register_warmup_handler(handler):
+    warmup_handlers.append(handler)
+
+def prepare_fork():
+    # Buffers of the parent process have to be written before they are copied into a child.
+    for handler in prefork_handlers:
+        handler()
+
+def reinitialize():
+    # Locks and threads of the parent process are not usable in a forked child.
+    global compiled_lock
+    compiled_lock = threading.Lock()
+    statistics.lock = threading.Lock()
+
+    for handler in fork_handlers:
+        handler()
+
+def post_fork(*args):
+    # Can be used as post_fork hook of gunicorn or with the postfork decorator of uWSGI.
+    reinitialize()
+
+    try:
+        Connector().warmup()
+    except Exception:
+        pass
 
 class Config:
     def __init__(self):
@@ -54,64 +139,1219 @@ class Config:
 
     def get(self, key, required = False, default = None):
         try:
-            return self.config.get(self.section, key)
-        except configparser.NoOptionError:
-            if required:
-                raise Exception(key + ' in config missing')
+            return self.config.get(self.section, key)
+        except (configparser.NoSectionError, configparser.NoOptionError):
+            if required:
+                raise Exception(key + ' in config missing')
+            else:
+                return default
+
+def get_config():
+    if os.environ.get('SHADOWD_CONNECTOR_CONFIG'):
+        file = os.environ.get('SHADOWD_CONNECTOR_CONFIG')
+    else:
+        file = SHADOWD_CONNECTOR_CONFIG
+
+    try:
+        mtime = os.stat(file).st_mtime
+    except OSError:
+        mtime = None
+
+    return compile_once(
+        ('config', file, os.environ.get('SHADOWD_CONNECTOR_CONFIG_SECTION'), mtime),
+        Config
+    )
+
+class Statistics:
+    def __init__(self):
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def increment(self, name, value = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def get(self):
+        with self.lock:
+            return dict(self.counters)
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+
+statistics = Statistics()
+
+class ClientAllowlist:
+    def __init__(self, networks):
+        # Every node of the binary radix tree is a list of [zero, one, terminal].
+        self.roots = {
+            4: [None, None, False],
+            6: [None, None, False]
+        }
+
+        for network in networks:
+            if network.strip():
+                self.add(network.strip())
+
+    def add(self, network):
+        network = ipaddress.ip_network(network, strict=False)
+        address = int(network.network_address)
+        width = network.max_prefixlen
+
+        node = self.roots[network.version]
+        for index in range(network.prefixlen):
+            bit = (address >> (width - 1 - index)) & 1
+
+            if node[bit] is None:
+                node[bit] = [None, None, False]
+
+            node = node[bit]
+
+        node[2] = True
+
+    def parse_address(self, value):
+        if not value:
+            return None
+
+        # Proxies append to forwarded lists, so only the last entry can be trusted.
+        value = value.split(',')[-1].strip()
+
+        # Remove brackets, ports and zone ids.
+        if value.startswith('['):
+            value = value[1:value.find(']')]
+        elif value.count(':') == 1:
+            value = value[:value.find(':')]
+
+        value = value.split('%')[0]
+
+        try:
+            address = ipaddress.ip_address(value)
+        except ValueError:
+            return None
+
+        if address.version == 6 and address.ipv4_mapped:
+            return address.ipv4_mapped
+
+        return address
+
+    def contains(self, value):
+        address = self.parse_address(value)
+
+        if address is None:
+            return False
+
+        bits = int(address)
+        width = address.max_prefixlen
+
+        node = self.roots[address.version]
+        for index in range(width):
+            if node[2]:
+                return True
+
+            node = node[(bits >> (width - 1 - index)) & 1]
+
+            if node is None:
+                return False
+
+        return node[2]
+
+def get_allowlist(networks):
+    return compile_once(('trusted_clients', networks), lambda: ClientAllowlist(networks.split(',')))
+
+class Throttle:
+    def __init__(self, rate, burst, size):
+        self.rate = rate
+        self.burst = burst
+        self.size = size
+
+        # Token buckets of the most recently seen clients, least recent first.
+        self.buckets = collections.OrderedDict()
+        self.lock = threading.Lock()
+        register_fork_handler(self.reset)
+
+    def reset(self):
+        self.lock = threading.Lock()
+
+    def allow(self, client):
+        now = time.monotonic()
+
+        with self.lock:
+            bucket = self.buckets.get(client)
+
+            if bucket is None:
+                tokens = self.burst
+            else:
+                tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                self.buckets.move_to_end(client)
+
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+
+            self.buckets[client] = (tokens, now)
+
+            if len(self.buckets) > self.size:
+                self.buckets.popitem(last=False)
+
+        return allowed
+
+class RoutePolicy:
+    def __init__(self, routes, default = 'protect'):
+        self.default = (default, {})
+        self.policies = []
+
+        # All routes are compiled into a single regex, the first matching route wins.
+        patterns = []
+        for index, route in enumerate(routes):
+            pattern = route[0]
+            policy = route[1]
+            options = route[2] if len(route) > 2 else {}
+
+            if policy not in ('skip', 'observe', 'protect', 'optimistic'):
+                raise Exception('unknown route policy: ' + str(policy))
+
+            # Patterns starting with ^ are regexes, everything else is a path prefix.
+            if not pattern.startswith('^'):
+                pattern = re.escape(pattern)
+
+            patterns.append('(?P<r' + str(index) + '>' + pattern + ')')
+            self.policies.append((policy, options))
+
+        self.regex = re.compile('|'.join(patterns)) if patterns else None
+
+    def lookup(self, path):
+        if self.regex:
+            match = self.regex.match(path)
+
+            if match:
+                return self.policies[int(match.lastgroup[1:])]
+
+        return self.default
+
+class NameFilter:
+    def __init__(self, allow, deny, normalize = None):
+        self.normalize = normalize
+        self.allow = self.compile_rules(allow)
+        self.deny = self.compile_rules(deny)
+
+    def compile_rules(self, rules):
+        if not rules:
+            return None
+
+        # Exact names are looked up in a set, wildcards are combined into one regex.
+        names = set()
+        patterns = []
+
+        for rule in rules.split(','):
+            rule = rule.strip()
+
+            if not rule:
+                continue
+
+            if self.normalize:
+                rule = self.normalize(rule)
+
+            if '*' in rule or '?' in rule or '[' in rule:
+                patterns.append(fnmatch.translate(rule))
+            else:
+                names.add(rule)
+
+        return (names, re.compile('|'.join(patterns)) if patterns else None)
+
+    def matches(self, rules, name):
+        if name in rules[0]:
+            return True
+
+        return bool(rules[1] and rules[1].match(name))
+
+    def accepts(self, name):
+        if self.allow and not self.matches(self.allow, name):
+            return False
+
+        if self.deny and self.matches(self.deny, name):
+            return False
+
+        return True
+
+def normalize_header(name):
+    name = name.upper().replace('-', '_')
+
+    if not name.startswith('HTTP_'):
+        name = 'HTTP_' + name
+
+    return name
+
+class InputBudgetExceeded(Exception):
+    def __init__(self, reason):
+        Exception.__init__(self, 'input budget exceeded: ' + reason)
+        self.reason = reason
+
+class InputBudget:
+    def __init__(self, action, max_fields, max_values, max_key_length, max_value_length, max_bytes):
+        if action not in ('truncate', 'reject', 'summary'):
+            raise Exception('unknown budget action: ' + str(action))
+
+        self.action = action
+        self.max_fields = max_fields
+        self.max_values = max_values
+        self.max_key_length = max_key_length
+        self.max_value_length = max_value_length
+        self.max_bytes = max_bytes
+
+    def exceed(self, input, reason):
+        if not input.budget_exceeded:
+            input.budget_exceeded = reason
+
+        if self.action == 'reject':
+            raise InputBudgetExceeded(reason)
+
+    def admit(self, input, path, value):
+        # Returns the value that should be saved, or None if the field is dropped.
+        if self.max_fields is not None and input.input_fields >= self.max_fields:
+            self.exceed(input, 'fields')
+            raise InputBudgetExceeded('fields')
+
+        if self.max_key_length is not None and len(path) > self.max_key_length:
+            self.exceed(input, 'key length')
+            return None
+
+        if value and self.max_value_length is not None and len(value) > self.max_value_length:
+            self.exceed(input, 'value length')
+            value = value[:self.max_value_length]
+
+        input.input_bytes += len(path) + (len(value) if value else 0)
+        if self.max_bytes is not None and input.input_bytes > self.max_bytes:
+            self.exceed(input, 'bytes')
+            raise InputBudgetExceeded('bytes')
+
+        input.input_fields += 1
+        return value
+
+    def summarize(self, fields, reason):
+        # Replaces the values with the number and size of the fields of every source.
+        sources = {}
+
+        for path, value in fields.items():
+            source = path.partition('|')[0]
+            count, size = sources.get(source, (0, 0))
+            sources[source] = (count + 1, size + len(path) + (len(value) if value else 0))
+
+        summary = {}
+
+        for source, (count, size) in sources.items():
+            summary['BUDGET|' + source + '|fields'] = str(count)
+            summary['BUDGET|' + source + '|bytes'] = str(size)
+
+        summary['BUDGET|exceeded'] = reason
+        return summary
+
+class BenignClassifier:
+    def __init__(self, patterns):
+        # Every value is matched on its own, joined values make the regex backtrack exponentially.
+        self.regexes = {}
+
+        for path_class, pattern in patterns:
+            self.regexes[path_class] = re.compile(pattern)
+
+    def classify(self, input):
+        for path, value in input.items():
+            regex = self.regexes.get(path.partition('|')[0])
+
+            if regex is None or not isinstance(value, str):
+                return False
+
+            if not regex.fullmatch(value):
+                return False
+
+        return True
+
+def get_benign_classifier(config):
+    patterns = tuple(
+        (path_class, config.get('benign_' + path_class.lower()))
+        for path_class in BENIGN_PATHS
+        if config.get('benign_' + path_class.lower())
+    )
+
+    if not patterns:
+        return None
+
+    return compile_once(('benign',) + patterns, lambda: BenignClassifier(patterns))
+
+class BlacklistEngine:
+    def __init__(self, filters):
+        self.filters = []
+        rules = []
+
+        for entry in filters:
+            try:
+                regex = re.compile(entry['rule'], re.IGNORECASE)
+            except re.error:
+                # Rules in a syntax that is not supported by Python are only evaluated by shadowd.
+                continue
+
+            self.filters.append((regex, int(entry['impact'])))
+            rules.append(entry['rule'])
+
+        # Most values match no rule at all, so all rules are tried at once before they are scored one by one.
+        self.prefilter = None
+
+        if rules and not any(re.search(r'\\[1-9]|\(\?P=', rule) for rule in rules):
+            try:
+                self.prefilter = re.compile('|'.join('(?:' + rule + ')' for rule in rules), re.IGNORECASE)
+            except re.error:
+                pass
+
+    def score(self, value):
+        if self.prefilter is not None and not self.prefilter.search(value):
+            return 0
+
+        impact = 0
+        for regex, filter_impact in self.filters:
+            if regex.search(value):
+                impact += filter_impact
+
+        return impact
+
+    def scan(self, input, threshold):
+        # Returns the paths with an impact of at least threshold and the highest impact.
+        threats = []
+        highest = 0
+
+        for path, value in input.items():
+            if not isinstance(value, str):
+                continue
+
+            impact = self.score(value)
+
+            if impact >= threshold:
+                threats.append(path)
+
+            highest = max(highest, impact)
+
+        return (threats, highest)
+
+def load_blacklist_engine(file):
+    with open(file, 'r') as handler:
+        return BlacklistEngine(json.load(handler))
+
+class VerdictCache:
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.generation = None
+
+        # Expiry times by digest of profile, caller, path and value, least recently judged first.
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        register_fork_handler(self.reset)
+
+    def reset(self):
+        self.lock = threading.Lock()
+
+    def digest(self, profile, caller, path, value):
+        # Whitelist rules and thresholds depend on the profile and the caller, so do the verdicts.
+        data = '\0'.join((str(profile), str(caller), path, value))
+        return hashlib.blake2b(bytes(data, 'utf-8', 'surrogatepass'), digest_size=16).digest()
+
+    def select(self, input, profile, caller, generation, complete = False):
+        # Returns the fields to send, the digests of the sent fields, and the number and size of omitted fields.
+        fields = {}
+        digests = {}
+        omitted = 0
+        saved = 0
+        now = time.monotonic()
+
+        with self.lock:
+            if generation != self.generation:
+                self.entries.clear()
+                self.generation = generation
+
+            for path, value in input.items():
+                if not isinstance(value, str):
+                    fields[path] = value
+                    continue
+
+                digest = self.digest(profile, caller, path, value)
+                expiry = self.entries.get(digest)
+
+                if not complete and expiry is not None and expiry > now:
+                    omitted += 1
+                    saved += len(json.dumps(path)) + len(json.dumps(value)) + 4
+                    continue
+
+                fields[path] = value
+                digests[path] = digest
+
+        return (fields, digests, omitted, saved)
+
+    def add(self, digests):
+        expiry = time.monotonic() + self.ttl
+
+        with self.lock:
+            for digest in digests:
+                self.entries[digest] = expiry
+                self.entries.move_to_end(digest)
+
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+class IgnoreIndex:
+    def __init__(self, entries):
+        # Callers whose input is ignored completely, and ignored paths by caller or None for all callers.
+        self.callers = set()
+        self.paths = {}
+
+        for entry in entries:
+            if 'path' not in entry:
+                if 'caller' in entry:
+                    self.callers.add(entry['caller'])
+            else:
+                self.paths.setdefault(entry.get('caller'), set()).add(entry['path'])
+
+    def apply(self, input, caller):
+        if caller in self.callers:
+            return {}
+
+        # Requests without an ignored path are sent unchanged.
+        for paths in (self.paths.get(None), self.paths.get(caller)):
+            if paths:
+                for path in paths:
+                    input.pop(path, None)
+
+        return input
+
+def load_ignore_index(file):
+    with open(file, 'r') as handler:
+        return IgnoreIndex(json.load(handler))
+
+def get_signer(key):
+    # The HMAC is keyed only once and copied for every message.
+    return compile_once(
+        ('signer', key),
+        lambda: hmac.new(bytes(key, 'utf-8'), digestmod=hashlib.sha256)
+    )
+
+class ProfileRouter:
+    def __init__(self, entries):
+        # Entries are grouped by host and sorted by the length of the path prefix.
+        self.hosts = {}
+        self.any_host = []
+
+        for entry in entries:
+            if 'profile' not in entry or 'key' not in entry:
+                raise Exception('profile or key of profile route missing')
+
+            route = (
+                entry.get('path', ''),
+                entry.get('caller'),
+                entry['profile'],
+                entry['key']
+            )
+            get_signer(entry['key'])
+
+            if entry.get('host'):
+                self.hosts.setdefault(entry['host'].lower(), []).append(route)
+            else:
+                self.any_host.append(route)
+
+        for routes in list(self.hosts.values()) + [self.any_host]:
+            routes.sort(key=lambda route: len(route[0]), reverse=True)
+
+    def lookup(self, host, path, caller):
+        if host:
+            routes = self.hosts.get(host.lower().split(':')[0])
+
+            if routes:
+                route = self.find(routes, path, caller)
+
+                if route:
+                    return route
+
+        return self.find(self.any_host, path, caller)
+
+    def find(self, routes, path, caller):
+        for route in routes:
+            if path is not None and not path.startswith(route[0]):
+                continue
+
+            if route[1] is not None and route[1] != caller:
+                continue
+
+            return (route[2], route[3])
+
+        return None
+
+def load_profile_router(file):
+    with open(file, 'r') as handler:
+        return ProfileRouter(json.load(handler))
+
+class UploadDigester:
+    def __init__(self, algorithm, max_size, pool_size, workers, timeout):
+        hashlib.new(algorithm)
+
+        self.algorithm = algorithm
+        self.max_size = max_size
+        self.pool_size = pool_size
+        self.workers = workers
+        self.timeout = timeout
+        self.pool = None
+        self.lock = threading.Lock()
+        register_fork_handler(self.reset)
+
+    def reset(self):
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def get_pool(self):
+        with self.lock:
+            if self.pool is None:
+                self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+
+            return self.pool
+
+    def get_buffer(self, source):
+        # In-memory uploads are hashed from a view of their buffer without copies.
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            return memoryview(source)
+
+        if isinstance(source, io.BytesIO):
+            return source.getbuffer()
+
+        inner = getattr(source, '_file', None)
+        if isinstance(inner, io.BytesIO):
+            return inner.getbuffer()
+
+        return None
+
+    def get_fileno(self, source):
+        try:
+            return source.fileno()
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            return None
+
+    def sniff(self, head):
+        for signature, type in UPLOAD_SIGNATURES:
+            if head.startswith(signature):
+                return type
+
+        return 'application/octet-stream'
+
+    def digest_buffer(self, buffer):
+        try:
+            digest = hashlib.new(self.algorithm, buffer)
+            return (digest.hexdigest(), len(buffer), self.sniff(bytes(buffer[:8])))
+        finally:
+            buffer.release()
+
+    def digest_file(self, fileno, size):
+        # Reading with an offset does not touch the file position of the application.
+        digest = hashlib.new(self.algorithm)
+        buffer = bytearray(65536)
+        view = memoryview(buffer)
+        head = b''
+        offset = 0
+
+        while offset < size:
+            length = os.preadv(fileno, [buffer], offset)
+
+            if not length:
+                break
+
+            if not offset:
+                head = bytes(view[:8])
+
+            digest.update(view[:length])
+            offset += length
+
+        return (digest.hexdigest(), offset, self.sniff(head))
+
+    def digest_duplicate(self, fileno, size):
+        try:
+            return self.digest_file(fileno, size)
+        finally:
+            os.close(fileno)
+
+    def digest_stream(self, source):
+        digest = hashlib.new(self.algorithm)
+        position = source.tell()
+        head = b''
+        size = 0
+
+        try:
+            source.seek(0)
+
+            for chunk in iter(lambda: source.read(65536), b''):
+                if not size:
+                    head = chunk[:8]
+
+                digest.update(chunk)
+                size += len(chunk)
+        finally:
+            source.seek(position)
+
+        return (digest.hexdigest(), size, self.sniff(head))
+
+    def run(self, uploads):
+        # Returns a list of (path, digest, size, type) tuples for all uploads that were hashed in time.
+        deadline = time.monotonic() + self.timeout
+        results = []
+        futures = {}
+
+        for path, source in uploads:
+            if time.monotonic() > deadline:
+                break
+
+            buffer = self.get_buffer(source)
+            if buffer is not None:
+                if self.max_size is not None and len(buffer) > self.max_size:
+                    buffer.release()
+                    continue
+
+                results.append((path,) + self.digest_buffer(buffer))
+                continue
+
+            fileno = self.get_fileno(source)
+            if fileno is not None and hasattr(os, 'preadv'):
+                size = os.fstat(fileno).st_size
+
+                if self.max_size is not None and size > self.max_size:
+                    continue
+
+                # Large files are hashed in parallel, hashlib releases the GIL. The workers read a duplicate of the
+                # descriptor, because the application may close the file after the timeout.
+                if size > self.pool_size:
+                    duplicate = os.dup(fileno)
+                    futures[self.get_pool().submit(self.digest_duplicate, duplicate, size)] = (path, duplicate)
+                else:
+                    results.append((path,) + self.digest_file(fileno, size))
+
+                continue
+
+            if hasattr(source, 'seek'):
+                results.append((path,) + self.digest_stream(source))
+
+        if futures:
+            done, not_done = concurrent.futures.wait(futures, timeout=max(0, deadline - time.monotonic()))
+
+            for future in done:
+                if future.exception() is None:
+                    results.append((futures[future][0],) + future.result())
+
+            if not_done:
+                statistics.increment('upload_digest_timeout', len(not_done))
+
+            # Jobs that did not start yet are dropped, so that they do not delay the uploads of later requests.
+            for future in not_done:
+                if future.cancel():
+                    os.close(futures[future][1])
+
+        return results
+
+class CheckPool:
+    def __init__(self, workers):
+        self.workers = workers
+        self.pool = None
+        self.lock = threading.Lock()
+        register_fork_handler(self.reset)
+
+    def reset(self):
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def submit(self, function, *args):
+        with self.lock:
+            if self.pool is None:
+                self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+
+        return self.pool.submit(function, *args)
+
+class CheckTrace:
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.time = time.time()
+        self.start = time.perf_counter()
+        self.last = self.start
+        self.phases = {}
+        self.verdict = None
+        self.server = None
+        self.connection = None
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0) + now - self.last
+        self.last = now
+
+    def finish(self, input, status):
+        # Returns the details of the check if it was slow, None otherwise.
+        self.mark('finish')
+
+        duration = self.last - self.start
+        if duration < self.threshold:
+            return None
+
+        # Only the sizes of the largest fields are kept, never the values.
+        fields = getattr(input, 'input', None)
+        if isinstance(fields, InputView):
+            fields = fields.data
+
+        largest = []
+        if fields is not None:
+            largest = heapq.nlargest(5, (
+                (len(value) if isinstance(value, (str, bytes)) else 0, path) for path, value in fields.items()
+            ))
+
+        if self.verdict is not None:
+            verdict = self.verdict
+        elif status == True:
+            verdict = 'skipped'
+        else:
+            verdict = 'stopped'
+
+        return {
+            'time':         self.time,
+            'duration':     duration,
+            'phases':       self.phases,
+            'caller':       input.get_caller(),
+            'fields':       len(fields) if fields is not None else None,
+            'largest':      [[path, size] for size, path in largest],
+            'payload':      getattr(self.connection, 'payload_size', None),
+            'connect':      getattr(self.connection, 'connect_time', None),
+            'connect_wait': getattr(self.connection, 'connect_wait', None),
+            'server':       self.server,
+            'verdict':      verdict
+        }
+
+class FlightRecorder:
+    def __init__(self, size):
+        # Appending to a deque is atomic, so the requests do not wait for a lock.
+        self.checks = collections.deque(maxlen=size)
+
+    def capture(self, check):
+        self.checks.append(check)
+
+    def get(self):
+        return list(self.checks)
+
+    def dump(self, file):
+        with open(file, 'w') as handler:
+            json.dump(self.get(), handler, indent=2)
+
+def get_flight_recorder(size):
+    return compile_once(('flight_recorder', size), lambda: FlightRecorder(size))
+
+def dump_slow_checks(file):
+    config = get_config()
+    get_flight_recorder(int(config.get('slow_check_size', default=100))).dump(file)
+
+def register_dump_signal(name, file):
+    # Signal handlers can only be registered in the main thread.
+    signum = int(name) if name.isdigit() else getattr(signal, name)
+    signal.signal(signum, lambda signum, frame: dump_slow_checks(file))
+
+class PendingCheck:
+    # The request is sent in the background while the application runs, the verdict is applied afterwards.
+    def __init__(self, connector, future, input, output, config, observe):
+        self.connector = connector
+        self.future = future
+        self.input = input
+        self.output = output
+        self.config = config
+        self.observe = observe
+
+    def result(self):
+        try:
+            status = self.future.result()
+
+            if self.input.trace:
+                self.input.trace.mark('wait')
+
+            result = self.connector.apply(status, self.input, self.output, self.config, self.observe)
+        except:
+            result = self.connector.fail(self.output, self.config, self.observe)
+
+        if self.input.trace:
+            self.connector.capture(self.input, result, self.config)
+
+        return result
+
+class HashIndex:
+    def __init__(self, interval):
+        self.interval = interval
+
+        # Routes point to source files, files point to [mtime, digest, time of last check].
+        self.routes = {}
+        self.files = {}
+
+    def get_source_file(self, callback):
+        callback = getattr(callback, 'view_class', callback)
+
+        try:
+            return inspect.getsourcefile(inspect.unwrap(callback))
+        except TypeError:
+            return None
+
+    def hash_file(self, file):
+        sha256 = hashlib.sha256()
+        with open(file, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                sha256.update(chunk)
+
+        return sha256.hexdigest()
+
+    def add(self, route, callback):
+        file = self.get_source_file(callback)
+
+        if not file or not os.path.isfile(file):
+            return
+
+        # The route is published last, so that concurrent lookups never see it without the hash of its file.
+        if file not in self.files:
+            self.files[file] = [os.stat(file).st_mtime, self.hash_file(file), time.monotonic()]
+
+        self.routes[route] = file
+
+    def lookup(self, route, callback = None):
+        file = self.routes.get(route)
+
+        if file is None:
+            if callback is None:
+                return {}
+
+            self.add(route, callback)
+            file = self.routes.get(route)
+
+            if file is None:
+                return {}
+
+        entry = self.files[file]
+
+        # The file is only checked for modifications once per interval.
+        now = time.monotonic()
+        if now - entry[2] > self.interval:
+            mtime = os.stat(file).st_mtime
+
+            if mtime != entry[0]:
+                entry = [mtime, self.hash_file(file), now]
+                self.files[file] = entry
+            else:
+                entry[2] = now
+
+        return {'sha256': entry[1]}
+
+def optional_int(value):
+    if value is None or value == '':
+        return None
+
+    return int(value)
+
+def is_json_mimetype(mimetype):
+    mimetype = mimetype.split(';')[0].strip().lower()
+    return mimetype == 'application/json' or mimetype.endswith('+json')
+
+class Input:
+    json = None
+    json_input = False
+    json_max_depth = 32
+    json_max_fields = 1000
+    upload_digester = None
+    uploads = ()
+    defused = False
+    benign = False
+    verdicts = None
+    trace = None
+    budget = None
+    budget_exceeded = None
+    header_filter = None
+    cookie_filter = None
+    header_max_length = None
+    cookie_max_length = None
+    lazy_input = False
+
+    def set_config(self, config):
+        self.config = config
+
+        # Compile the selection of headers and cookies only once.
+        headers_allow = config.get('headers_allow')
+        headers_deny = config.get('headers_deny')
+        if headers_allow or headers_deny:
+            self.header_filter = compile_once(
+                ('headers', headers_allow, headers_deny),
+                lambda: NameFilter(headers_allow, headers_deny, normalize_header)
+            )
+
+        cookies_allow = config.get('cookies_allow')
+        cookies_deny = config.get('cookies_deny')
+        if cookies_allow or cookies_deny:
+            self.cookie_filter = compile_once(
+                ('cookies', cookies_allow, cookies_deny),
+                lambda: NameFilter(cookies_allow, cookies_deny)
+            )
+
+        header_max_length = config.get('headers_max_length')
+        if header_max_length:
+            self.header_max_length = int(header_max_length)
+
+        cookie_max_length = config.get('cookies_max_length')
+        if cookie_max_length:
+            self.cookie_max_length = int(cookie_max_length)
+
+        # Flatten JSON bodies if enabled.
+        if config.get('json_input'):
+            self.json_input = True
+            self.json_max_depth = int(config.get('json_max_depth', default=32))
+            self.json_max_fields = int(config.get('json_max_fields', default=1000))
+
+        # Hash the content of uploads if enabled.
+        if config.get('upload_digests'):
+            digester = (
+                config.get('upload_digest_algorithm', default='sha256'),
+                config.get('upload_digest_max_size', default=104857600),
+                config.get('upload_digest_pool_size', default=1048576),
+                config.get('upload_digest_workers', default=4),
+                config.get('upload_digest_timeout', default=1)
+            )
+            self.upload_digester = compile_once(
+                ('upload_digester',) + digester,
+                lambda: UploadDigester(
+                    digester[0],
+                    optional_int(digester[1]),
+                    int(digester[2]),
+                    int(digester[3]),
+                    float(digester[4])
+                )
+            )
+
+        # Limit the size of the input to stop oversized requests early.
+        budget = (
+            config.get('budget_action', default='truncate'),
+            config.get('max_fields'),
+            config.get('max_values'),
+            config.get('max_key_length'),
+            config.get('max_value_length'),
+            config.get('max_bytes')
+        )
+        if any(budget[1:]):
+            self.budget = compile_once(
+                ('budget',) + budget,
+                lambda: InputBudget(budget[0], *[optional_int(limit) for limit in budget[1:]])
+            )
+
+        # Serialize the input straight from the containers of the framework if enabled.
+        if config.get('lazy_input'):
+            self.lazy_input = True
+
+    def get_client_ip(self):
+        raise NotImplementedError()
+
+    def get_caller(self):
+        raise NotImplementedError()
+
+    def get_resource(self):
+        raise NotImplementedError()
+
+    def get_host(self):
+        return None
+
+    def gather_input(self):
+        # Reset input.
+        self.reset_input()
+
+        if self.lazy_input:
+            self.input = InputView(self)
+        else:
+            self.collect(self.iterate_input())
+
+    def iterate_input(self):
+        raise NotImplementedError()
+
+    def defuse_input(self, threats):
+        raise NotImplementedError()
+
+    def gather_hashes(self):
+        raise NotImplementedError()
+
+    def get_input(self):
+        return self.input
+
+    def materialise_input(self):
+        if isinstance(self.input, InputView):
+            self.input = self.input.materialise()
+
+        return self.input
+
+    def reset_input(self):
+        self.input = {}
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.input_bytes = 0
+        self.input_fields = 0
+        self.budget_exceeded = None
+        self.uploads = []
+
+    def add_input(self, path, value):
+        if self.budget:
+            value = self.budget.admit(self, path, value)
+
+            if value is None:
+                return
+
+        self.input[path] = value
+
+    def collect(self, pairs):
+        for path, value in pairs:
+            self.add_input(path, value)
+
+    def add_values(self, path, values):
+        self.collect(self.iterate_values(path, values))
+
+    def iterate_values(self, path, values):
+        if self.budget and self.budget.max_values is not None and len(values) > self.budget.max_values:
+            self.budget.exceed(self, 'values')
+            values = values[:self.budget.max_values]
+
+        if len(values) > 1:
+            for index, value in enumerate(values):
+                yield (path + '|' + str(index), value)
+        else:
+            yield (path, values[0])
+
+    def parse_json(self, data):
+        # Returns the parsed body if it is a JSON object or array, None otherwise.
+        try:
+            if isinstance(data, bytes):
+                data = data.decode('utf-8')
+
+            tree = json.loads(data)
+        except ValueError:
+            return None
+
+        if not isinstance(tree, (dict, list)):
+            return None
+
+        return tree
+
+    def add_json(self, tree):
+        self.collect(self.iterate_json(tree))
+
+    def iterate_json(self, tree):
+        self.json = tree
+
+        # The tree is flattened iteratively, so that deep nesting can not exhaust the stack.
+        stack = [('JSON', tree, 0)]
+        fields = 0
+
+        while stack:
+            path, node, depth = stack.pop()
+
+            # Nodes below the maximum depth or after the maximum number of fields are sent as serialized JSON,
+            # so that nothing is hidden from shadowd. The input budget still limits the number of fields.
+            if isinstance(node, (dict, list)) and depth < self.json_max_depth and fields < self.json_max_fields:
+                if isinstance(node, dict):
+                    children = [(path + '|' + self.escape_key(key), value) for key, value in node.items()]
+                else:
+                    children = [(path + '|' + str(index), value) for index, value in enumerate(node)]
+
+                for child_path, child in reversed(children):
+                    stack.append((child_path, child, depth + 1))
+
+                continue
+
+            if isinstance(node, str):
+                value = node
+            else:
+                value = json.dumps(node)
+
+            yield (path, value)
+            fields += 1
+
+    def defuse_json(self, path_split):
+        if self.json is None:
+            return False
+
+        keys = [self.unescape_key(key) for key in path_split[1:]]
+
+        try:
+            node = self.json
+            for key in keys[:-1]:
+                node = node[int(key)] if isinstance(node, list) else node[key]
+
+            if isinstance(node, list):
+                node[int(keys[-1])] = ''
             else:
-                return default
+                if keys[-1] not in node:
+                    return False
 
-class Input:
-    def set_config(self, config):
-        self.config = config
+                node[keys[-1]] = ''
+        except (KeyError, IndexError, ValueError, TypeError):
+            return False
 
-    def get_client_ip(self):
-        raise NotImplementedError()
+        return True
 
-    def get_caller(self):
-        raise NotImplementedError()
+    def add_upload(self, path, source):
+        if self.upload_digester:
+            self.uploads.append((path, source))
 
-    def get_resource(self):
-        raise NotImplementedError()
+    def add_uploads(self, path, sources):
+        if not self.upload_digester:
+            return
 
-    def gather_input(self):
-        raise NotImplementedError()
+        if self.budget and self.budget.max_values is not None:
+            sources = sources[:self.budget.max_values]
 
-    def defuse_input(self, threats):
-        raise NotImplementedError()
+        if len(sources) > 1:
+            for index, source in enumerate(sources):
+                self.add_upload(path + '|' + str(index), source)
+        else:
+            self.add_upload(path, sources[0])
 
-    def gather_hashes(self):
-        raise NotImplementedError()
+    def gather_uploads(self):
+        # The view digests the uploads after the other fields.
+        if not isinstance(self.input, InputView):
+            self.collect(self.iterate_uploads())
 
-    def get_input(self):
-        return self.input
+    def iterate_uploads(self):
+        if not self.upload_digester or not self.uploads:
+            return
 
-    def get_hashes(self):
-        return self.hashes
+        # The digests are added as FILEHASH, FILESIZE and FILETYPE next to the FILES path.
+        for path, digest, size, type in self.upload_digester.run(self.uploads):
+            suffix = path[len('FILES'):]
 
-    def remove_ignored(self, file):
-        handler = open(file, 'r')
+            yield ('FILEHASH' + suffix, digest)
+            yield ('FILESIZE' + suffix, str(size))
+            yield ('FILETYPE' + suffix, type)
 
-        if not handler:
-            raise Exception('could not open ignore file')
+    def add_header(self, key, value):
+        self.collect(self.iterate_header(key, value))
 
-        content = handler.read()
-        json_data = json.loads(content)
+    def iterate_header(self, key, value):
+        if self.header_filter and not self.header_filter.accepts(key):
+            return
 
-        handler.close()
+        if self.header_max_length is not None:
+            value = value[:self.header_max_length]
 
-        for entry in json_data:
-            if 'path' not in entry and 'caller' in entry:
-                if self.get_caller() == entry['caller']:
-                    self.input = {}
-                    break
-            else:
-                if 'caller' in entry:
-                    if self.get_caller() == entry['caller']:
-                        continue
+        yield ('SERVER|' + self.escape_key(key), value)
 
-                if 'path' in entry:
-                    del self.input[entry['path']]
+    def add_cookie(self, key, value):
+        self.collect(self.iterate_cookie(key, value))
+
+    def iterate_cookie(self, key, value):
+        if self.cookie_filter and not self.cookie_filter.accepts(key):
+            return
+
+        if self.cookie_max_length is not None:
+            value = value[:self.cookie_max_length]
+
+        yield ('COOKIE|' + self.escape_key(key), value)
+
+    def get_hashes(self):
+        return self.hashes
+
+    def remove_ignored(self, file):
+        index = load_file_once(file, load_ignore_index)
+        self.input = index.apply(self.materialise_input(), self.get_caller())
 
     def escape_key(self, key):
         return key.replace('\\', '\\\\').replace('|', '\\|')
@@ -145,6 +1385,178 @@ class Input:
         output.append('' . join(current))
         return output
 
+class InputView(collections.abc.MutableMapping):
+    # Yields the fields straight from the containers of the framework, a dict is only built on demand.
+    def __init__(self, input):
+        self.owner = input
+        self.data = None
+
+    def materialise(self):
+        if self.data is None:
+            self.data = dict(self.iterate())
+
+        return self.data
+
+    def iterate(self):
+        input = self.owner
+
+        # A summary is only known after all fields were admitted.
+        if input.budget and input.budget.action == 'summary':
+            fields = dict(self.admit())
+
+            if input.budget_exceeded:
+                fields = input.budget.summarize(fields, input.budget_exceeded)
+
+            yield from fields.items()
+            return
+
+        yield from self.admit()
+
+        if input.budget_exceeded:
+            yield ('BUDGET|exceeded', input.budget_exceeded)
+
+    def admit(self):
+        input = self.owner
+        input.reset_counters()
+
+        try:
+            for path, value in itertools.chain(input.iterate_input(), input.iterate_uploads()):
+                if input.budget:
+                    value = input.budget.admit(input, path, value)
+
+                    if value is None:
+                        continue
+
+                yield (path, value)
+        except InputBudgetExceeded:
+            if input.budget.action == 'reject':
+                raise
+
+    def items(self):
+        if self.data is not None:
+            return self.data.items()
+
+        return self.iterate()
+
+    def to_json(self):
+        # Same output as json.dumps, without keeping the fields in memory.
+        encode = json.encoder.encode_basestring_ascii
+        fields = []
+
+        for path, value in self.items():
+            fields.append(encode(path) + ': ' + (encode(value) if isinstance(value, str) else json.dumps(value)))
+
+        return '{' + ', '.join(fields) + '}'
+
+    def __getitem__(self, path):
+        return self.materialise()[path]
+
+    def __setitem__(self, path, value):
+        self.materialise()[path] = value
+
+    def __delitem__(self, path):
+        del self.materialise()[path]
+
+    def __iter__(self):
+        return iter(self.materialise())
+
+    def __len__(self):
+        return len(self.materialise())
+
+class StaticInput(Input):
+    def __init__(self, client_ip, caller, resource, input, hashes = None):
+        self.client_ip = client_ip
+        self.caller = caller
+        self.resource = resource
+        self.input = input
+        self.hashes = hashes or {}
+
+    def get_client_ip(self):
+        return self.client_ip
+
+    def get_caller(self):
+        return self.caller
+
+    def get_resource(self):
+        return self.resource
+
+    def gather_input(self):
+        # The input is already flattened.
+        pass
+
+    def defuse_input(self, threats):
+        for path in threats:
+            if path in self.input:
+                self.input[path] = ''
+
+        return True
+
+    def gather_hashes(self):
+        pass
+
+class Recorder:
+    def __init__(self, file, flush):
+        self.file = file
+        self.flush = flush
+        self.records = []
+        self.lock = threading.Lock()
+        register_fork_handler(self.reset, self.close)
+
+    def reset(self):
+        # The records of the parent were written before the fork, the child must not write them a second time.
+        self.records = []
+        self.lock = threading.Lock()
+
+    def write(self, input):
+        record = json.dumps({
+            'caller':   input.get_caller(),
+            'resource': input.get_resource(),
+            'input':    input.materialise_input(),
+            'hashes':   input.get_hashes()
+        })
+
+        with self.lock:
+            self.records.append(record)
+
+            if len(self.records) >= self.flush:
+                self.write_records()
+
+    def write_records(self):
+        # Every batch is a complete gzip member that is appended with a single write, so that forked processes
+        # can share the file.
+        if not self.records:
+            return
+
+        data = gzip.compress(bytes('\n'.join(self.records) + '\n', 'utf-8'))
+        self.records = []
+
+        with open(self.file, 'ab', buffering=0) as handle:
+            handle.write(data)
+
+    def close(self):
+        with self.lock:
+            self.write_records()
+
+def get_recorder(file, flush):
+    def create():
+        recorder = Recorder(file, flush)
+        atexit.register(recorder.close)
+        return recorder
+
+    return compile_once(('recorder', file, flush), create)
+
+def read_records(file):
+    # A truncated last record of a crashed process is skipped.
+    with gzip.open(file, 'rb') as handle:
+        try:
+            for line in handle:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+        except EOFError:
+            return
+
 class Output:
     def set_config(self, config):
         self.config = config
@@ -164,21 +1576,165 @@ class Output:
 
         handler.close()
 
+class Resolver:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.addresses = {}
+
+    def resolve(self, host, port):
+        now = time.monotonic()
+        entry = self.addresses.get((host, port))
+
+        if entry and entry[0] > now:
+            return entry[1]
+
+        addresses = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        self.addresses[(host, port)] = (now + self.ttl, addresses)
+
+        return addresses
+
+    def forget(self, host, port):
+        self.addresses.pop((host, port), None)
+
+def get_resolver(ttl):
+    return compile_once(('resolver', ttl), lambda: Resolver(ttl))
+
+def create_ssl_context(ssl_cert):
+    # The certificate of the server is verified, but not its host name.
+    context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH, cafile=ssl_cert)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_REQUIRED
+
+    return context
+
+def get_ssl_context(ssl_cert):
+    return compile_once(('ssl', ssl_cert), lambda: create_ssl_context(ssl_cert))
+
 class Connection:
-    def send(self, input, host, port, profile, key, ssl_cert):
-        connection = None
-        connection_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    def __init__(self, config = None):
+        dns_ttl = 60
+        self.tcp_nodelay = False
+        self.tcp_fastopen = False
+        self.sndbuf = None
+        self.rcvbuf = None
+        self.connect_timeout = None
+        self.pending = None
+        self.connect_time = None
+        self.connect_wait = None
 
-        if ssl_cert:
-            connection = ssl.wrap_socket(
-                connection_socket,
-                ca_certs=ssl_cert,
-                cert_reqs=ssl.CERT_REQUIRED
-            )
+        if config:
+            dns_ttl = float(config.get('dns_ttl', default=60))
+            self.tcp_nodelay = bool(config.get('tcp_nodelay'))
+            self.tcp_fastopen = bool(config.get('tcp_fastopen'))
+            self.sndbuf = optional_int(config.get('sndbuf'))
+            self.rcvbuf = optional_int(config.get('rcvbuf'))
+
+            connect_timeout = config.get('connect_timeout')
+            if connect_timeout:
+                self.connect_timeout = float(connect_timeout)
+
+        self.resolver = get_resolver(dns_ttl)
+
+    def get_unix_path(self, host):
+        if host.startswith('unix:'):
+            return host[len('unix:'):]
+
+        return None
+
+    def configure_socket(self, connection_socket, tcp):
+        if self.sndbuf:
+            connection_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf)
+
+        if self.rcvbuf:
+            connection_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+
+        if tcp and self.tcp_nodelay:
+            connection_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        if tcp and self.tcp_fastopen and TCP_FASTOPEN_CONNECT is not None:
+            try:
+                connection_socket.setsockopt(socket.IPPROTO_TCP, TCP_FASTOPEN_CONNECT, 1)
+            except OSError:
+                # Not supported by the kernel.
+                pass
+
+        connection_socket.settimeout(self.connect_timeout)
+
+    def connect(self, host, port, ssl_cert):
+        unix_path = self.get_unix_path(host)
+
+        if unix_path:
+            addresses = [(socket.AF_UNIX, socket.SOCK_STREAM, 0, '', unix_path)]
         else:
-            connection = connection_socket
+            addresses = self.resolver.resolve(host, port)
+
+        error = None
+
+        for family, type, proto, _, address in addresses:
+            connection_socket = socket.socket(family, type, proto)
+
+            try:
+                self.configure_socket(connection_socket, not unix_path)
+                connection_socket.connect(address)
+                connection_socket.settimeout(None)
+            except OSError as e:
+                connection_socket.close()
+                error = e
+                continue
+
+            if ssl_cert:
+                return get_ssl_context(ssl_cert).wrap_socket(connection_socket)
+
+            return connection_socket
+
+        if unix_path:
+            raise error
+
+        # The cached addresses might be outdated.
+        self.resolver.forget(host, port)
+        raise error
+
+    def preconnect(self, host, port, ssl_cert, pool):
+        # The connection is established in the background, e.g., while the input is gathered.
+        def connect():
+            start = time.perf_counter()
+            connection_socket = self.connect(host, port, ssl_cert)
+            self.connect_time = time.perf_counter() - start
+
+            return connection_socket
 
-        connection.connect((host, port))
+        self.pending = ((host, port, ssl_cert), pool.submit(connect))
+
+    def get_socket(self, host, port, ssl_cert):
+        pending = self.pending
+        self.pending = None
+
+        # Connect directly if the background connection has not started yet.
+        if pending is None or not pending[0] == (host, port, ssl_cert) or pending[1].cancel():
+            if pending is not None:
+                self.discard(pending[1])
+
+            return self.connect(host, port, ssl_cert)
+
+        start = time.perf_counter()
+        connection_socket = pending[1].result()
+        self.connect_wait = time.perf_counter() - start
+
+        return connection_socket
+
+    def discard(self, future):
+        future.add_done_callback(
+            lambda future: future.cancelled() or future.exception() is not None or future.result().close()
+        )
+
+    def close(self):
+        # Closes a connection that was established in advance, but was never used.
+        if self.pending is not None:
+            self.discard(self.pending[1])
+            self.pending = None
+
+    def send(self, input, host, port, profile, key, ssl_cert):
+        connection = self.get_socket(host, port, ssl_cert)
 
         input_data = {
             'version':   SHADOWD_CONNECTOR_VERSION,
@@ -189,10 +1745,11 @@ class Connection:
             'hashes':    input.get_hashes()
         }
 
-        json_data = json.dumps(input_data)
+        json_data = self.encode(input_data)
         json_hmac = self.sign(key, json_data)
         data_bytes = bytes(str(profile) + "\n" + json_hmac + "\n" + json_data + "\n", 'utf-8')
         connection.sendall(data_bytes)
+        self.payload_size = len(data_bytes)
 
         output = ''
 
@@ -208,6 +1765,17 @@ class Connection:
 
         return self.parse_output(output)
 
+    def encode(self, input_data):
+        if not isinstance(input_data['input'], InputView):
+            return json.dumps(input_data)
+
+        # The view is written field by field into the JSON document.
+        parts = []
+        for key, value in input_data.items():
+            parts.append(json.dumps(key) + ': ' + (value.to_json() if key == 'input' else json.dumps(value)))
+
+        return '{' + ', '.join(parts) + '}'
+
     def parse_output(self, output):
         data = json.loads(output)
 
@@ -236,21 +1804,216 @@ class Connection:
             raise Exception('processing error')
 
     def sign(self, key, json):
-        key_bytes = bytes(key , 'utf-8')
         json_bytes = bytes(json, 'utf-8')
-        return hmac.new(key_bytes, json_bytes, hashlib.sha256).hexdigest()
+
+        signer = get_signer(key).copy()
+        signer.update(json_bytes)
+        return signer.hexdigest()
 
 class Connector:
-    def start(self, input, output):
-        config = Config()
+    def warmup(self, connect = False):
+        config = get_config()
+
+        # Parse all files and compile all settings before the first request.
+        ignored = config.get('ignore')
+        if ignored:
+            load_file_once(ignored, load_ignore_index)
+
+        profiles = config.get('profiles')
+        if profiles:
+            load_file_once(profiles, load_profile_router)
+
+        trusted_clients = config.get('trusted_clients')
+        if trusted_clients:
+            get_allowlist(trusted_clients)
+
+        key = config.get('key')
+        if key:
+            get_signer(key)
+
+        ssl_cert = config.get('ssl')
+        if ssl_cert:
+            get_ssl_context(ssl_cert)
+
+        # Resolve the address of the server and optionally test the connection.
+        connection = Connection(config)
+        host = config.get('host', default='127.0.0.1')
+        port = int(config.get('port', default=9115))
+
+        if not connection.get_unix_path(host):
+            connection.resolver.resolve(host, port)
+
+        if connect:
+            connection.connect(host, port, ssl_cert).close()
+
+        # Dump the slow checks on a signal.
+        slow_check_signal = config.get('slow_check_signal')
+        if slow_check_signal:
+            register_dump_signal(slow_check_signal, config.get('slow_check_file', required=True))
+
+        # Let the framework connectors prepare their own data, e.g. the hashes of the views.
+        for handler in warmup_handlers:
+            handler(config)
+
+    def check_many(self, records, concurrency = 16, client_ip = '127.0.0.1', profile = None, key = None):
+        # Yields (index, status, error) of every (caller, resource, input) record in the order of completion.
+        config = get_config()
+
+        host = config.get('host', default='127.0.0.1')
+        port = int(config.get('port', default=9115))
+        profile = profile or config.get('profile', required=True)
+        key = key or config.get('key', required=True)
+        ssl_cert = config.get('ssl')
+        ignored = config.get('ignore')
+
+        def check(caller, resource, input):
+            # The ignore rules remove fields in place, the records of the caller are not changed.
+            static_input = StaticInput(client_ip, caller, resource, dict(input))
+
+            if ignored:
+                static_input.remove_ignored(ignored)
+
+            return Connection(config).send(static_input, host, port, profile, key, ssl_cert)
+
+        # Records are only read while less than twice the concurrency is pending.
+        iterator = enumerate(records)
+        exhausted = False
+        pending = {}
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+
+        try:
+            while True:
+                while not exhausted and len(pending) < concurrency * 2:
+                    try:
+                        index, record = next(iterator)
+                    except StopIteration:
+                        exhausted = True
+                        break
+
+                    pending[pool.submit(check, *record)] = index
+
+                if not pending:
+                    return
+
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+
+                for future in done:
+                    index = pending.pop(future)
+                    error = future.exception()
+
+                    yield (index, None if error else future.result(), error)
+        finally:
+            for future in pending:
+                future.cancel()
+
+            pool.shutdown(wait=False)
+
+    def start(self, input, output, observe = None, profile = None, key = None, background = False):
+        config = get_config()
+
+        # The phases are only timed if slow checks are captured.
+        slow_check_threshold = config.get('slow_check_threshold')
+        if not slow_check_threshold:
+            return self.check(config, input, output, observe, profile, key, background)
+
+        input.trace = CheckTrace(float(slow_check_threshold))
+        status = self.check(config, input, output, observe, profile, key, background)
+
+        if not isinstance(status, PendingCheck):
+            self.capture(input, status, config)
+
+        return status
+
+    def capture(self, input, status, config):
+        check = input.trace.finish(input, status)
+
+        if check is not None:
+            statistics.increment('slow_checks')
+            get_flight_recorder(int(config.get('slow_check_size', default=100))).capture(check)
+
+    def check(self, config, input, output, observe, profile, key, background):
+        if observe is None:
+            observe = config.get('observe')
+
+        connection = None
+        handed_off = False
 
         try:
             # Add config for subclasses.
             input.set_config(config)
             output.set_config(config)
 
+            # Skip trusted clients completely, but still verify a sample of them.
+            trusted_clients = config.get('trusted_clients')
+            if trusted_clients:
+                if get_allowlist(trusted_clients).contains(input.get_client_ip()):
+                    sample = float(config.get('trusted_clients_sample', default=0))
+
+                    if random.random() >= sample:
+                        return True
+
+            # Stop single clients from flooding the shadowd server.
+            throttle_rate = config.get('throttle_rate')
+            if throttle_rate:
+                throttle_burst = config.get('throttle_burst', default=throttle_rate)
+                throttle_clients = config.get('throttle_clients', default=10000)
+                throttle = compile_once(
+                    ('throttle', throttle_rate, throttle_burst, throttle_clients),
+                    lambda: Throttle(float(throttle_rate), float(throttle_burst), int(throttle_clients))
+                )
+
+                if throttle.allow(input.get_client_ip()):
+                    statistics.increment('throttle_allowed')
+                elif random.random() < float(config.get('throttle_sample', default=0)):
+                    statistics.increment('throttle_sampled')
+                else:
+                    statistics.increment('throttle_rejected')
+
+                    if config.get('debug'):
+                        output.log('shadowd: throttled client: ' + str(input.get_client_ip()))
+
+                    if observe:
+                        return True
+
+                    return output.error()
+
+            # Connect to the shadowd server while the input is gathered. If the request can be finished locally the
+            # connection is only started after these decisions, so that it is not wasted.
+            connection = Connection(config)
+            preconnect = config.get('preconnect')
+            if preconnect and not self.has_local_decisions(config, observe):
+                self.preconnect(connection, config)
+                preconnect = False
+
             # Collect user input and remove sensitive data.
-            input.gather_input()
+            try:
+                input.gather_input()
+                input.gather_uploads()
+            except InputBudgetExceeded:
+                # Gathering stops at the first field over the budget.
+                pass
+
+            if input.trace:
+                input.trace.mark('gather')
+
+            if input.budget_exceeded:
+                statistics.increment('budget_exceeded')
+
+                if config.get('debug'):
+                    output.log('shadowd: input budget exceeded (' + input.budget_exceeded + ') from client: '
+                        + str(input.get_client_ip()))
+
+                if input.budget.action == 'reject':
+                    if observe:
+                        return True
+
+                    return output.error()
+
+                # The marker tells shadowd that it did not see the complete input.
+                if input.budget.action == 'summary':
+                    input.input = input.budget.summarize(input.get_input(), input.budget_exceeded)
+                else:
+                    input.get_input()['BUDGET|exceeded'] = input.budget_exceeded
 
             ignored = config.get('ignore')
             if ignored:
@@ -259,39 +2022,231 @@ class Connector:
             # Collect cryptographically secure checksums of the executed script.
             input.gather_hashes()
 
-            # Establish a connection with the server and transmit the data.
-            connection = Connection()
-            status = connection.send(
-                input,
+            # Record the input for replays.
+            record = config.get('record')
+            if record:
+                get_recorder(record, int(config.get('record_flush', default=100))).write(input)
+
+            # Skip the shadowd server if every value is inert, but still verify a sample of them.
+            classifier = get_benign_classifier(config)
+            if classifier and not input.get_hashes():
+                if not classifier.classify(input.materialise_input()):
+                    statistics.increment('benign_checked')
+                elif random.random() < float(config.get('benign_sample', default=0)):
+                    statistics.increment('benign_sampled')
+                    input.benign = True
+                else:
+                    statistics.increment('benign_skipped')
+                    return True
+
+            # Stop obvious attacks locally, the shadowd server still checks the complete input.
+            blacklist_filters = config.get('blacklist_filters')
+            if blacklist_filters and not observe:
+                engine = load_file_once(blacklist_filters, load_blacklist_engine)
+                threats, impact = engine.scan(
+                    input.materialise_input(),
+                    int(config.get('blacklist_threshold', default=10))
+                )
+
+                blacklist_critical = config.get('blacklist_critical')
+                if blacklist_critical and impact >= int(blacklist_critical):
+                    statistics.increment('blacklist_critical')
+
+                    if config.get('debug'):
+                        output.log('shadowd: stopped critical attack locally from client: ' + str(input.get_client_ip()))
+
+                    return output.error()
+
+                if threats:
+                    statistics.increment('blacklist_defused')
+
+                    if not input.defuse_input(threats):
+                        if config.get('debug'):
+                            output.log('shadowd: stopped attack locally from client: ' + str(input.get_client_ip()))
+
+                        return output.error()
+
+                    input.defused = True
+
+                    if config.get('debug'):
+                        output.log('shadowd: removed threat locally from client: ' + str(input.get_client_ip()))
+
+            if preconnect:
+                self.preconnect(connection, config)
+
+            # Select the profile of the application if multiple profiles are configured.
+            profiles = config.get('profiles')
+            if profiles and profile is None:
+                router = load_file_once(profiles, load_profile_router)
+                route = router.lookup(input.get_host(), input.get_resource(), input.get_caller())
+
+                if route:
+                    profile, key = route
+
+            profile = profile or config.get('profile', required=True)
+            key = key or config.get('key', required=True)
+
+            # Fields that were judged clean before are not sent again, except for a sample of complete requests.
+            checked_input = input
+            verdict_cache_size = config.get('verdict_cache_size')
+            if verdict_cache_size:
+                verdict_cache_ttl = config.get('verdict_cache_ttl', default=300)
+                cache = compile_once(
+                    ('verdict_cache', verdict_cache_size, verdict_cache_ttl),
+                    lambda: VerdictCache(int(verdict_cache_size), float(verdict_cache_ttl))
+                )
+
+                # The cached verdicts are dropped if the ignored paths change.
+                generation = (ignored, os.stat(ignored).st_mtime if ignored else None)
+                complete = random.random() < float(config.get('verdict_cache_complete', default=0.01))
+
+                fields, digests, omitted, saved = cache.select(
+                    input.materialise_input(),
+                    profile,
+                    input.get_caller(),
+                    generation,
+                    complete
+                )
+                input.verdicts = (cache, digests)
+
+                if omitted:
+                    statistics.increment('verdict_cache_fields', omitted)
+                    statistics.increment('verdict_cache_bytes', saved)
+
+                checked_input = StaticInput(
+                    input.get_client_ip(),
+                    input.get_caller(),
+                    input.get_resource(),
+                    fields,
+                    input.get_hashes()
+                )
+
+            # Transmit the data to the server.
+            arguments = (
+                checked_input,
                 config.get('host', default='127.0.0.1'),
                 int(config.get('port', default=9115)),
-                config.get('profile', required=True),
-                config.get('key', required=True),
+                profile,
+                key,
                 config.get('ssl')
             )
 
-            # If observe is not enabled remove threats.
-            if not config.get('observe') and status['attack']:
-                if status['critical']:
-                    if config.get('debug'):
-                        output.log('shadowd: stopped critical attack from client: ' + input.get_client_ip())
+            if input.trace:
+                input.trace.mark('prepare')
+                host = arguments[1]
+                input.trace.server = host if connection.get_unix_path(host) else host + ':' + str(arguments[2])
+                input.trace.connection = connection
 
-                    return output.error()
+            if background:
+                # The input is not read by the thread of the application and the background thread at once.
+                input.materialise_input()
 
-                if not input.defuse_input(status['threats']):
-                    if config.get('debug'):
-                        output.log('shadowd: stopped attack from client: ' + input.get_client_ip())
+                # Only threats that are removed after the application ran require another run.
+                input.defused = False
 
-                    return output.error()
+                workers = int(config.get('optimistic_workers', default=4))
+                pool = compile_once(('check_pool', workers), lambda: CheckPool(workers))
 
-                if config.get('debug'):
-                    output.log('shadowd: removed threat from client: ' + input.get_client_ip())
+                handed_off = True
+                return PendingCheck(self, pool.submit(connection.send, *arguments), input, output, config, observe)
+
+            status = connection.send(*arguments)
+
+            if input.trace:
+                input.trace.mark('send')
+
+            return self.apply(status, input, output, config, observe)
+        except InputBudgetExceeded as e:
+            # A lazy input view is rejected only while it is serialized.
+            statistics.increment('budget_exceeded')
+
+            if config.get('debug'):
+                output.log('shadowd: input budget exceeded (' + e.reason + ') from client: '
+                    + str(input.get_client_ip()))
+
+            if not observe:
+                return output.error()
         except:
+            return self.fail(output, config, observe)
+        finally:
+            if connection is not None and not handed_off:
+                connection.close()
+
+        return True
+
+    def apply(self, status, input, output, config, observe):
+        # Remember the fields that were judged clean, critical attacks have no threats to exclude.
+        if input.verdicts:
+            cache, digests = input.verdicts
+
+            if not status['attack']:
+                cache.add(digests.values())
+            elif not status['critical']:
+                cache.add(digests[path] for path in digests if path not in status['threats'])
+
+        if input.benign and status['attack']:
+            statistics.increment('benign_mismatch')
+
             if config.get('debug'):
-                tb = traceback.format_exc()
-                output.log(tb)
+                output.log('shadowd: attack in benign input from client: ' + str(input.get_client_ip()))
+
+        if input.trace:
+            if not status['attack']:
+                input.trace.verdict = 'ok'
+            elif status['critical']:
+                input.trace.verdict = 'critical'
+            else:
+                input.trace.verdict = 'attack'
+
+        # If observe is not enabled remove threats.
+        if not observe and status['attack']:
+            if status['critical']:
+                if config.get('debug'):
+                    output.log('shadowd: stopped critical attack from client: ' + input.get_client_ip())
 
-            if not config.get('observe'):
                 return output.error()
 
+            if not input.defuse_input(status['threats']):
+                if config.get('debug'):
+                    output.log('shadowd: stopped attack from client: ' + input.get_client_ip())
+
+                return output.error()
+
+            input.defused = True
+
+            if config.get('debug'):
+                output.log('shadowd: removed threat from client: ' + input.get_client_ip())
+
+        return True
+
+    def has_local_decisions(self, config, observe):
+        # Returns True if the input budget, the benign classifier or the local blacklist can finish the request.
+        if config.get('budget_action') == 'reject':
+            return True
+
+        if get_benign_classifier(config):
+            return True
+
+        return bool(config.get('blacklist_filters')) and not observe
+
+    def preconnect(self, connection, config):
+        workers = int(config.get('preconnect_workers', default=16))
+        connection.preconnect(
+            config.get('host', default='127.0.0.1'),
+            int(config.get('port', default=9115)),
+            config.get('ssl'),
+            compile_once(('connect_pool', workers), lambda: CheckPool(workers))
+        )
+
+    def fail(self, output, config, observe):
+        if config.get('debug'):
+            tb = traceback.format_exc()
+            output.log(tb)
+
+        if not observe:
+            return output.error()
+
         return True
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(before=prepare_fork, after_in_child=reinitialize)
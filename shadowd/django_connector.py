@@ -14,8 +14,20 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
-from .connector import Input, Output, Connector
+import io
+import json
+import asyncio
+import functools
+
+from .connector import Input, Output, Connector, RoutePolicy, HashIndex, PendingCheck, compile_once, register_warmup_handler, UPLOAD_PATHS, is_json_mimetype
+from django.conf import settings
 from django.http import HttpResponseServerError
+from django.urls import get_resolver, resolve, Resolver404
+
+try:
+    from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+except ImportError:
+    iscoroutinefunction = None
 
 
 class InputDjango(Input):
@@ -31,21 +43,17 @@ class InputDjango(Input):
     def get_resource(self):
         return self.request.get_full_path()
 
-    def gather_input(self):
-        # Reset input.
-        self.input = {}
+    def get_host(self):
+        return self.request.META.get('HTTP_HOST')
 
+    def iterate_input(self):
         # Save GET parameters in input.
         get_input = self.request.GET
         for key in get_input:
             path = 'GET|' + self.escape_key(key)
             values = get_input.getlist(key)
 
-            if len(values) > 1:
-                for index, value in enumerate(values):
-                    self.input[path + '|' + str(index)] = value
-            else:
-                self.input[path] = values[0]
+            yield from self.iterate_values(path, values)
 
         # Save POST parameters in input.
         post_input = self.request.POST
@@ -53,20 +61,24 @@ class InputDjango(Input):
             path = 'POST|' + self.escape_key(key)
             values = post_input.getlist(key)
 
-            if len(values) > 1:
-                for index, value in enumerate(values):
-                    self.input[path + '|' + str(index)] = value
-            else:
-                self.input[path] = values[0]
+            yield from self.iterate_values(path, values)
+
+        # Flatten JSON data and share the parsed tree with the application.
+        if self.json_input and is_json_mimetype(self.request.META.get('CONTENT_TYPE', '')):
+            tree = self.parse_json(self.request.body)
+
+            if tree is not None:
+                self.request.shadowd_json = tree
+                yield from self.iterate_json(tree)
 
         # Save cookies in input.
         for key in self.request.COOKIES:
-            self.input['COOKIE|' + self.escape_key(key)] = self.request.COOKIES[key]
+            yield from self.iterate_cookie(key, self.request.COOKIES[key])
 
         # Save headers in input.
         for key in self.request.META:
             if key[:5] == 'HTTP_':
-                self.input['SERVER|' + self.escape_key(key)] = self.request.META[key]
+                yield from self.iterate_header(key, self.request.META[key])
 
         # Save the file names of uploads.
         files_input = self.request.FILES
@@ -74,16 +86,14 @@ class InputDjango(Input):
             path = 'FILES|' + self.escape_key(key)
             values = files_input.getlist(key)
 
-            if len(values) > 1:
-                for index, value in enumerate(values):
-                    self.input[path + '|' + str(index)] = value.name
-            else:
-                self.input[path] = values[0].name
+            yield from self.iterate_values(path, [value.name for value in values])
+            self.add_uploads(path, [value.file for value in values])
 
     def defuse_input(self, threats):
         # Get the input and create copy to make it mutable.
         get_input = self.request.GET.copy()
         post_input = self.request.POST.copy()
+        json_changed = False
 
         # Remove threats.
         for path in threats:
@@ -114,7 +124,9 @@ class InputDjango(Input):
                     post_input.setlist(key, post_list)
                 else:
                     post_input[key] = ''
-            elif path_split[0] == 'FILES':
+            elif path_split[0] == 'JSON':
+                json_changed = self.defuse_json(path_split) or json_changed
+            elif path_split[0] in UPLOAD_PATHS:
                 # Can't remove file uploads, so request has to be stopped.
                 return False
 
@@ -124,13 +136,151 @@ class InputDjango(Input):
         # Update the POST data.
         self.request.POST = post_input
 
+        # Update the JSON data, it is serialized only once.
+        if json_changed:
+            body = json.dumps(self.json).encode('utf-8')
+
+            self.request._body = body
+            self.request._stream = io.BytesIO(body)
+
         # Don't stop the complete request.
         return True
 
     def gather_hashes(self):
-        # Integrity check not supported, because everything is routed through one file.
+        # Reset hashes.
         self.hashes = {}
 
+        # The integrity check uses the precomputed hashes of the view modules.
+        if not self.config.get('integrity'):
+            return
+
+        match = getattr(self.request, 'resolver_match', None)
+        if match is not None:
+            view = match.func
+        else:
+            # The middleware runs before the URL is resolved, so the views of recent paths are cached.
+            urlconf = getattr(self.request, 'urlconf', None) or settings.ROOT_URLCONF
+            view = resolve_view(self.request.path_info, urlconf)
+
+            if view is None:
+                return
+
+        index = precompute_hashes(float(self.config.get('integrity_interval', default=10)))
+        self.hashes = index.lookup(view, view)
+
+@functools.lru_cache(maxsize=4096)
+def resolve_view(path, urlconf):
+    try:
+        return resolve(path, urlconf).func
+    except Resolver404:
+        return None
+
+def collect_views(patterns, index):
+    for pattern in patterns:
+        if hasattr(pattern, 'url_patterns'):
+            collect_views(pattern.url_patterns, index)
+        else:
+            index.add(pattern.callback, pattern.callback)
+
+def precompute_hashes(interval = 10):
+    def build():
+        index = HashIndex(interval)
+        collect_views(get_resolver().url_patterns, index)
+        return index
+
+    return compile_once(('integrity_django', interval), build)
+
+def warmup_hashes(config):
+    if config.get('integrity'):
+        precompute_hashes(float(config.get('integrity_interval', default=10)))
+
+register_warmup_handler(warmup_hashes)
+
 class OutputDjango(Output):
     def error(self):
         return HttpResponseServerError('<h1>500 Internal Server Error</h1>')
+
+class ShadowdMiddleware:
+    sync_capable = True
+    async_capable = iscoroutinefunction is not None
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.routes = RoutePolicy(
+            getattr(settings, 'SHADOWD_ROUTES', ()),
+            getattr(settings, 'SHADOWD_DEFAULT_POLICY', 'protect')
+        )
+
+        self.is_async = self.async_capable and iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+
+        status = self.check(request)
+        if isinstance(status, PendingCheck):
+            response, rerun = self.resolve(status, self.get_response(request))
+
+            if rerun:
+                return self.get_response(request)
+
+            return response
+
+        if not status == True:
+            return status
+
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        status = await sync_to_async(self.check, thread_sensitive=False)(request)
+        if isinstance(status, PendingCheck):
+            response = await self.get_response(request)
+
+            # The verdict is awaited without blocking the event loop.
+            await asyncio.wait([asyncio.wrap_future(status.future)])
+            response, rerun = self.resolve(status, response)
+
+            if rerun:
+                return await self.get_response(request)
+
+            return response
+
+        if not status == True:
+            return status
+
+        return await self.get_response(request)
+
+    def resolve(self, pending, response):
+        # Returns the response and whether the view has to run again with the defused request.
+        status = pending.result()
+
+        if status == True and not pending.input.defused:
+            return (response, False)
+
+        response.close()
+
+        if status == True:
+            return (None, True)
+
+        return (status, False)
+
+    def check(self, request):
+        policy, options = self.routes.lookup(request.path_info)
+
+        # Skipped routes never build the input.
+        if policy == 'skip':
+            return True
+
+        # Only safe methods run the view before the verdict is known.
+        background = policy == 'optimistic' and request.method in ('GET', 'HEAD')
+
+        return Connector().start(
+            InputDjango(request),
+            OutputDjango(),
+            observe=(True if policy == 'observe' else None),
+            profile=options.get('profile'),
+            key=options.get('key'),
+            background=background
+        )
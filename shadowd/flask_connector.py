@@ -15,11 +15,34 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 from .werkzeug_connector import InputWerkzeug, Output, Connector
-from flask import abort
+from .connector import HashIndex, compile_once
+from flask import abort, current_app
 
 
 class InputFlask(InputWerkzeug):
-    pass
+    def gather_hashes(self):
+        # Reset hashes.
+        self.hashes = {}
+
+        # The integrity check uses the precomputed hashes of the view modules.
+        if not self.config.get('integrity') or not self.request.endpoint:
+            return
+
+        app = current_app._get_current_object()
+        index = precompute_hashes(app, float(self.config.get('integrity_interval', default=10)))
+        self.hashes = index.lookup(self.request.endpoint, app.view_functions.get(self.request.endpoint))
+
+def precompute_hashes(app, interval = 10):
+    def build():
+        index = HashIndex(interval)
+
+        for rule in app.url_map.iter_rules():
+            if rule.endpoint in app.view_functions:
+                index.add(rule.endpoint, app.view_functions[rule.endpoint])
+
+        return index
+
+    return compile_once(('integrity_flask', id(app), interval), build)
 
 class OutputFlask(Output):
     def error(self):
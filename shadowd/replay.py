@@ -0,0 +1,187 @@
+# Shadow Daemon -- Web Application Firewall
+#
+# Copyright (C) 2014-2022 Hendrik Buchwald <hb@zecure.org>
+#
+# This file is part of Shadow Daemon. Shadow Daemon is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import time
+import argparse
+import itertools
+import collections
+import concurrent.futures
+
+from .connector import StaticInput, Connection, read_records
+
+
+def replay_record(record, options):
+    input = StaticInput(
+        options['client_ip'],
+        record['caller'],
+        record['resource'],
+        record['input'],
+        record['hashes']
+    )
+
+    start = time.perf_counter()
+
+    try:
+        status = Connection().send(
+            input,
+            options['host'],
+            options['port'],
+            options['profile'],
+            options['key'],
+            options['ssl']
+        )
+    except Exception:
+        return (time.perf_counter() - start, 'error')
+
+    if not status['attack']:
+        verdict = 'ok'
+    elif status['critical']:
+        verdict = 'critical'
+    else:
+        verdict = 'attack'
+
+    return (time.perf_counter() - start, verdict)
+
+def replay_records(records, options):
+    # Every record has a fixed start time, so that the rate does not depend on the latency.
+    rate = options['rate']
+    start = time.monotonic()
+
+    def run(index, record):
+        if rate:
+            delay = start + index / rate - time.monotonic()
+
+            if delay > 0:
+                time.sleep(delay)
+
+        return replay_record(record, options)
+
+    latencies = []
+    verdicts = collections.Counter()
+
+    def collect(futures):
+        for future in futures:
+            latency, verdict = future.result()
+            latencies.append(latency)
+            verdicts[verdict] += 1
+
+    # The records are streamed into the pool, only a few of them are kept in memory at the same time.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=options['concurrency']) as pool:
+        pending = set()
+
+        for index, record in enumerate(records):
+            if len(pending) >= options['concurrency'] * 2:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                collect(done)
+
+            pending.add(pool.submit(run, index, record))
+
+        collect(concurrent.futures.wait(pending)[0])
+
+    return (latencies, verdicts)
+
+def replay_file(file, options, offset = 0, step = 1, limit = None):
+    return replay_records(itertools.islice(read_records(file), offset, limit, step), options)
+
+def replay(file, options, processes = 1, limit = None):
+    start = time.monotonic()
+
+    if processes > 1:
+        # Every process reads the file and replays every n-th record with its share of the rate.
+        process_options = dict(options)
+        if options['rate']:
+            process_options['rate'] = options['rate'] / processes
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as pool:
+            futures = [
+                pool.submit(replay_file, file, process_options, index, processes, limit)
+                for index in range(processes)
+            ]
+            results = [future.result() for future in futures]
+    else:
+        results = [replay_file(file, options, limit=limit)]
+
+    duration = time.monotonic() - start
+
+    latencies = sorted(latency for result in results for latency in result[0])
+    verdicts = collections.Counter()
+    for result in results:
+        verdicts.update(result[1])
+
+    return create_report(latencies, verdicts, duration)
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def create_report(latencies, verdicts, duration):
+    return {
+        'requests':   len(latencies),
+        'duration':   duration,
+        'throughput': len(latencies) / duration if duration else 0,
+        'latency': {
+            'p50': percentile(latencies, 0.5),
+            'p90': percentile(latencies, 0.9),
+            'p99': percentile(latencies, 0.99),
+            'max': latencies[-1] if latencies else 0
+        },
+        'verdicts': dict(verdicts)
+    }
+
+def print_report(report):
+    print('requests:   %d' % report['requests'])
+    print('duration:   %.2f s' % report['duration'])
+    print('throughput: %.1f requests/s' % report['throughput'])
+
+    for name in ('p50', 'p90', 'p99', 'max'):
+        print('latency %s: %.2f ms' % (name, report['latency'][name] * 1000))
+
+    for verdict in sorted(report['verdicts']):
+        print('verdict %s: %d' % (verdict, report['verdicts'][verdict]))
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay recorded requests against a shadowd server.')
+    parser.add_argument('file', help='file written by the record setting of the connector')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9115)
+    parser.add_argument('--profile', required=True)
+    parser.add_argument('--key', required=True)
+    parser.add_argument('--ssl', help='path to the certificate of the server')
+    parser.add_argument('--client-ip', default='127.0.0.1')
+    parser.add_argument('--rate', type=float, default=0, help='requests per second, 0 for no limit')
+    parser.add_argument('--concurrency', type=int, default=8, help='concurrent requests per process')
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--limit', type=int, help='maximum number of records')
+    args = parser.parse_args()
+
+    options = {
+        'host':        args.host,
+        'port':        args.port,
+        'profile':     args.profile,
+        'key':         args.key,
+        'ssl':         args.ssl,
+        'client_ip':   args.client_ip,
+        'rate':        args.rate,
+        'concurrency': args.concurrency
+    }
+
+    print_report(replay(args.file, options, args.processes, args.limit))
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -23,4 +23,6 @@ def test_all():
         'shadowd.tests.test_cgi_connector',
         'shadowd.tests.test_django_connector',
         'shadowd.tests.test_werkzeug_connector',
+        'shadowd.tests.test_wsgi_connector',
+        'shadowd.tests.test_replay',
     ])
@@ -0,0 +1,114 @@
+# Shadow Daemon -- Web Application Firewall
+#
+# Copyright (C) 2014-2022 Hendrik Buchwald <hb@zecure.org>
+#
+# This file is part of Shadow Daemon. Shadow Daemon is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import hmac
+import hashlib
+import socket
+import socketserver
+import tempfile
+import threading
+
+import shadowd.connector
+
+
+def respond_ok(profile, data):
+    return {'status': shadowd.connector.STATUS_OK}
+
+def respond_attack(profile, data):
+    # Every value that contains "attack" is reported as threat.
+    threats = [path for path, value in data['input'].items() if 'attack' in str(value)]
+
+    if threats:
+        return {'status': shadowd.connector.STATUS_ATTACK, 'threats': threats}
+
+    return {'status': shadowd.connector.STATUS_OK}
+
+class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        profile = self.rfile.readline().strip().decode('utf-8')
+        signature = self.rfile.readline().strip().decode('utf-8')
+        content = self.rfile.readline().strip()
+
+        with self.server.stand_in.lock:
+            self.server.stand_in.connections += 1
+
+        # Connections that are closed without a request are not counted as request.
+        if not content:
+            return
+
+        self.server.stand_in.requests.append(content)
+
+        expected = hmac.new(bytes(self.server.stand_in.key, 'utf-8'), content, hashlib.sha256).hexdigest()
+        if not hmac.compare_digest(signature, expected):
+            output = {'status': shadowd.connector.STATUS_BAD_SIGNATURE}
+        else:
+            output = self.server.stand_in.respond(profile, json.loads(content))
+
+        self.wfile.write(bytes(json.dumps(output), 'utf-8'))
+
+class TCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+if hasattr(socket, 'AF_UNIX'):
+    class UnixServer(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+
+class StandInServer:
+    # Answers like shadowd on a TCP port and, if supported, on a Unix domain socket.
+    def __init__(self, key = 'foo', respond = respond_ok, unix = True):
+        self.key = key
+        self.respond = respond
+        self.requests = []
+        self.connections = 0
+        self.lock = threading.Lock()
+        self.servers = []
+        self.unix_path = None
+
+        tcp_server = TCPServer(('127.0.0.1', 0), Handler)
+        tcp_server.stand_in = self
+        self.servers.append(tcp_server)
+        self.port = tcp_server.server_address[1]
+
+        if unix and hasattr(socket, 'AF_UNIX'):
+            self.unix_path = os.path.join(tempfile.mkdtemp(), 'shadowd.sock')
+
+            unix_server = UnixServer(self.unix_path, Handler)
+            unix_server.stand_in = self
+            self.servers.append(unix_server)
+
+    def start(self):
+        for server in self.servers:
+            threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+
+        return self
+
+    def stop(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+        if self.unix_path:
+            os.remove(self.unix_path)
+            os.rmdir(os.path.dirname(self.unix_path))
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
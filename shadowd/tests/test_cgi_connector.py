@@ -54,6 +54,19 @@ class TestCgiConnector(unittest.TestCase):
         self.assertIn('GET|foo|1', input)
         self.assertEqual(input['GET|foo|1'], 'bar2')
 
+    def test_get_input_array_budget(self):
+        os.environ['REQUEST_METHOD'] = 'GET'
+        os.environ['QUERY_STRING'] = 'foo=bar1&foo=bar2&foo=bar3'
+
+        i = shadowd.cgi_connector.InputCGI()
+        i.budget = shadowd.connector.InputBudget('truncate', None, 2, None, None, None)
+        i.gather_input()
+
+        input = i.get_input()
+        self.assertEqual(i.budget_exceeded, 'values')
+        self.assertEqual(input['GET|foo|1'], 'bar2')
+        self.assertNotIn('GET|foo|2', input)
+
     def test_defuse_input(self):
         os.environ['REQUEST_METHOD'] = 'GET'
         os.environ['QUERY_STRING'] = 'foo=bar'
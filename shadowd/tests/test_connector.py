@@ -14,8 +14,75 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
+import io
+import os
+import contextlib
+import time
+import hashlib
+import tempfile
+import importlib.util
+import json
+import socket
 import unittest
+import threading
 import shadowd.connector
+import shadowd.tests.server
+
+
+class DummyInput(shadowd.connector.Input):
+    def __init__(self, client_ip='127.0.0.1'):
+        self.client_ip = client_ip
+        self.gathered = False
+
+    def get_client_ip(self):
+        return self.client_ip
+
+    def get_caller(self):
+        return 'foo'
+
+    def get_resource(self):
+        return '/foo'
+
+    def gather_input(self):
+        self.gathered = True
+        self.reset_input()
+        self.add_input('GET|foo', 'bar')
+
+    def gather_hashes(self):
+        self.hashes = {}
+
+class DummyIterableInput(DummyInput):
+    def gather_input(self):
+        self.gathered = True
+        shadowd.connector.Input.gather_input(self)
+
+    def iterate_input(self):
+        yield from self.iterate_values('GET|foo', ['bar', 'baz'])
+        yield from self.iterate_json({'foo': ['bar', 1, None]})
+        yield from self.iterate_header('HTTP_FOO', 'b\u00e4r')
+        yield ('DATA|raw', 'bar')
+
+class DummyOutput(shadowd.connector.Output):
+    def error(self):
+        return 'error'
+
+@contextlib.contextmanager
+def write_config(options):
+    handle, file = tempfile.mkstemp(suffix='.ini')
+
+    with os.fdopen(handle, 'w') as f:
+        f.write('[shadowd_python]\n')
+
+        for key in options:
+            f.write(key + '=' + str(options[key]) + '\n')
+
+    os.environ['SHADOWD_CONNECTOR_CONFIG'] = file
+
+    try:
+        yield file
+    finally:
+        del os.environ['SHADOWD_CONNECTOR_CONFIG']
+        os.remove(file)
 
 
 class TestConnector(unittest.TestCase):
@@ -64,3 +131,827 @@ class TestConnector(unittest.TestCase):
         test6 = i.split_path('foo\\')
         self.assertEqual(len(test6), 1)
         self.assertEqual(test6[0], 'foo\\')
+
+    def test_client_allowlist(self):
+        a = shadowd.connector.ClientAllowlist(['10.0.0.0/8', '192.168.1.1', '2001:db8::/32'])
+
+        self.assertTrue(a.contains('10.1.2.3'))
+        self.assertTrue(a.contains('192.168.1.1'))
+        self.assertFalse(a.contains('192.168.1.2'))
+        self.assertFalse(a.contains('11.0.0.1'))
+        self.assertTrue(a.contains('2001:db8::1'))
+        self.assertTrue(a.contains('[2001:db8::1]:443'))
+        self.assertFalse(a.contains('fe80::1%eth0'))
+        self.assertFalse(a.contains('2001:db9::1'))
+        self.assertTrue(a.contains('::ffff:10.0.0.1'))
+        self.assertTrue(a.contains('10.0.0.1:8080'))
+        self.assertFalse(a.contains('foo'))
+        self.assertFalse(a.contains(None))
+
+    def test_client_allowlist_forwarded(self):
+        a = shadowd.connector.ClientAllowlist(['10.0.0.0/8'])
+
+        self.assertTrue(a.contains('1.2.3.4, 10.0.0.1'))
+        self.assertFalse(a.contains('10.0.0.1, 1.2.3.4'))
+
+    def test_start_trusted_client(self):
+        with write_config({
+            'profile': 1,
+            'key': 'foo',
+            'port': 1,
+            'trusted_clients': '10.0.0.0/8'
+        }):
+            i = DummyInput('10.0.0.1')
+            self.assertTrue(shadowd.connector.Connector().start(i, DummyOutput()))
+            self.assertFalse(i.gathered)
+
+            i = DummyInput('11.0.0.1')
+            self.assertEqual(shadowd.connector.Connector().start(i, DummyOutput()), 'error')
+            self.assertTrue(i.gathered)
+
+    def test_throttle(self):
+        t = shadowd.connector.Throttle(0.001, 2, 2)
+
+        self.assertTrue(t.allow('1.1.1.1'))
+        self.assertTrue(t.allow('1.1.1.1'))
+        self.assertFalse(t.allow('1.1.1.1'))
+        self.assertTrue(t.allow('2.2.2.2'))
+
+        # The least recently used client is evicted if the table is full.
+        self.assertTrue(t.allow('3.3.3.3'))
+        self.assertNotIn('1.1.1.1', t.buckets)
+        self.assertTrue(t.allow('1.1.1.1'))
+
+    def test_start_throttle(self):
+        with write_config({
+            'profile': 1,
+            'key': 'foo',
+            'port': 1,
+            'throttle_rate': 0.001,
+            'throttle_burst': 1
+        }):
+            shadowd.connector.statistics.reset()
+
+            i = DummyInput('10.0.0.2')
+            self.assertEqual(shadowd.connector.Connector().start(i, DummyOutput()), 'error')
+            self.assertTrue(i.gathered)
+
+            i = DummyInput('10.0.0.2')
+            self.assertEqual(shadowd.connector.Connector().start(i, DummyOutput()), 'error')
+            self.assertFalse(i.gathered)
+
+            counters = shadowd.connector.statistics.get()
+            self.assertEqual(counters['throttle_allowed'], 1)
+            self.assertEqual(counters['throttle_rejected'], 1)
+
+    def test_route_policy(self):
+        p = shadowd.connector.RoutePolicy([
+            ('/static/', 'skip'),
+            ('^/api/v[0-9]+/', 'observe'),
+            ('/', 'protect', {'profile': 2})
+        ], 'skip')
+
+        self.assertEqual(p.lookup('/static/foo.js'), ('skip', {}))
+        self.assertEqual(p.lookup('/api/v1/foo'), ('observe', {}))
+        self.assertEqual(p.lookup('/api/foo'), ('protect', {'profile': 2}))
+        self.assertEqual(p.lookup('foo'), ('skip', {}))
+
+        with self.assertRaises(Exception):
+            shadowd.connector.RoutePolicy([('/', 'foo')])
+
+    def test_name_filter(self):
+        f = shadowd.connector.NameFilter('', 'X-Trace-*, authorization', shadowd.connector.normalize_header)
+
+        self.assertTrue(f.accepts('HTTP_USER_AGENT'))
+        self.assertFalse(f.accepts('HTTP_AUTHORIZATION'))
+        self.assertFalse(f.accepts('HTTP_X_TRACE_ID'))
+
+        f = shadowd.connector.NameFilter('session, pref_*', 'pref_analytics')
+
+        self.assertTrue(f.accepts('session'))
+        self.assertTrue(f.accepts('pref_lang'))
+        self.assertFalse(f.accepts('pref_analytics'))
+        self.assertFalse(f.accepts('Session'))
+        self.assertFalse(f.accepts('jwt'))
+
+    def test_add_header_cookie(self):
+        i = shadowd.connector.Input()
+        i.input = {}
+        i.header_filter = shadowd.connector.NameFilter('', 'HTTP_FOO', shadowd.connector.normalize_header)
+        i.cookie_max_length = 3
+
+        i.add_header('HTTP_FOO', 'bar')
+        i.add_header('HTTP_BAR', 'foo')
+        i.add_cookie('foo', 'foobar')
+
+        self.assertEqual(i.get_input(), {'SERVER|HTTP_BAR': 'foo', 'COOKIE|foo': 'foo'})
+
+    def test_input_budget_truncate(self):
+        i = shadowd.connector.Input()
+        i.budget = shadowd.connector.InputBudget('truncate', 3, 2, 10, 3, None)
+        i.reset_input()
+
+        i.add_values('GET|foo', ['bar1', 'bar2', 'bar3'])
+        self.assertEqual(i.budget_exceeded, 'values')
+        i.add_input('GET|foobarbaz', 'bar')
+        i.add_input('GET|bar', 'bar')
+
+        self.assertEqual(i.get_input(), {'GET|foo|0': 'bar', 'GET|foo|1': 'bar', 'GET|bar': 'bar'})
+
+        with self.assertRaises(shadowd.connector.InputBudgetExceeded):
+            i.add_input('GET|baz', 'baz')
+
+    def test_input_budget_reject(self):
+        i = shadowd.connector.Input()
+        i.budget = shadowd.connector.InputBudget('reject', None, None, None, None, 10)
+        i.reset_input()
+
+        i.add_input('GET|foo', 'bar')
+        self.assertIsNone(i.budget_exceeded)
+
+        with self.assertRaises(shadowd.connector.InputBudgetExceeded):
+            i.add_input('GET|bar', 'foo')
+
+        self.assertEqual(i.budget_exceeded, 'bytes')
+
+    def test_start_budget(self):
+        with write_config({
+            'profile': 1,
+            'key': 'foo',
+            'port': 1,
+            'max_fields': 0,
+            'budget_action': 'reject'
+        }):
+            shadowd.connector.statistics.reset()
+
+            i = DummyInput()
+            self.assertEqual(shadowd.connector.Connector().start(i, DummyOutput()), 'error')
+            self.assertEqual(i.get_input(), {})
+            self.assertEqual(shadowd.connector.statistics.get()['budget_exceeded'], 1)
+
+    def test_start_budget_summary(self):
+        with write_config({
+            'profile': 1,
+            'key': 'foo',
+            'port': 1,
+            'max_fields': 2,
+            'budget_action': 'summary'
+        }):
+            i = DummyIterableInput()
+            self.assertEqual(shadowd.connector.Connector().start(i, DummyOutput()), 'error')
+            self.assertEqual(i.get_input(), {
+                'BUDGET|GET|fields': '2',
+                'BUDGET|GET|bytes': '24',
+                'BUDGET|exceeded': 'fields'
+            })
+
+    def test_input_view(self):
+        i = DummyIterableInput()
+        i.gather_input()
+        expected = i.get_input()
+
+        i.lazy_input = True
+        i.gather_input()
+        self.assertIsInstance(i.get_input(), shadowd.connector.InputView)
+        self.assertEqual(i.get_input().to_json(), json.dumps(expected))
+        self.assertEqual(i.get_input().to_json(), json.dumps(expected))
+
+        i.budget = shadowd.connector.InputBudget('summary', 3, None, None, None, None)
+        i.gather_input()
+        self.assertEqual(json.loads(i.get_input().to_json()), {
+            'BUDGET|GET|fields': '2',
+            'BUDGET|GET|bytes': '24',
+            'BUDGET|JSON|fields': '1',
+            'BUDGET|JSON|bytes': '13',
+            'BUDGET|exceeded': 'fields'
+        })
+
+        i.budget = shadowd.connector.InputBudget('truncate', 3, None, None, None, None)
+        i.gather_input()
+        self.assertEqual(json.loads(i.get_input().to_json()), {
+            'GET|foo|0': 'bar',
+            'GET|foo|1': 'baz',
+            'JSON|foo|0': 'bar',
+            'BUDGET|exceeded': 'fields'
+        })
+
+        # Removing ignored fields needs a dict.
+        del i.get_input()['GET|foo|1']
+        self.assertIsInstance(i.materialise_input(), dict)
+        self.assertEqual(len(i.get_input()), 3)
+
+        i.budget = shadowd.connector.InputBudget('reject', 3, None, None, None, None)
+        i.gather_input()
+        with self.assertRaises(shadowd.connector.InputBudgetExceeded):
+            i.get_input().to_json()
+
+    def test_send_lazy(self):
+        with shadowd.tests.server.StandInServer(unix=False) as server:
+            c = shadowd.connector.Connection()
+
+            i = DummyIterableInput()
+            i.gather_input()
+            i.gather_hashes()
+            c.send(i, '127.0.0.1', server.port, 1, 'foo', None)
+
+            i.lazy_input = True
+            i.gather_input()
+            c.send(i, '127.0.0.1', server.port, 1, 'foo', None)
+
+            self.assertEqual(server.requests[0], server.requests[1])
+
+    def test_benign_classifier(self):
+        c = shadowd.connector.BenignClassifier([('GET', '[\\w.-]{0,8}'), ('SERVER', '[\\w ./();-]{0,64}')])
+
+        self.assertTrue(c.classify({}))
+        self.assertTrue(c.classify({'GET|id': '42', 'GET|q': 'foo-bar', 'SERVER|HTTP_USER_AGENT': 'Mozilla/5.0 (X11)'}))
+        self.assertFalse(c.classify({'GET|id': '42', 'GET|q': '123456789'}))
+        self.assertFalse(c.classify({'GET|q': "' or 1=1"}))
+        self.assertFalse(c.classify({'GET|q': 'foo\nbar'}))
+        self.assertFalse(c.classify({'GET|id': '42', 'POST|id': '42'}))
+
+        # Patterns that match newlines must not backtrack over the values of a request.
+        c = shadowd.connector.BenignClassifier([('GET', '[^<>]{0,64}')])
+        input = dict(('GET|' + str(index), 'a') for index in range(40))
+        input['GET|x'] = '<'
+
+        start = time.monotonic()
+        self.assertFalse(c.classify(input))
+        self.assertLess(time.monotonic() - start, 0.1)
+        self.assertTrue(c.classify({'GET|q': 'foo\nbar'}))
+
+    def test_start_benign(self):
+        with shadowd.tests.server.StandInServer(unix=False) as server:
+            with write_config({
+                'profile': 1,
+                'key': 'foo',
+                'port': server.port,
+                'benign_get': '[a-z]{0,3}',
+                'benign_sample': 0
+            }):
+                shadowd.connector.statistics.reset()
+
+                self.assertTrue(shadowd.connector.Connector().start(DummyInput(), DummyOutput()))
+                self.assertEqual(len(server.requests), 0)
+
+                i = DummyInput()
+                i.gather_input = lambda: i.reset_input() or i.add_input('GET|foo', 'bar baz')
+                self.assertTrue(shadowd.connector.Connector().start(i, DummyOutput()))
+                self.assertEqual(len(server.requests), 1)
+
+                counters = shadowd.connector.statistics.get()
+                self.assertEqual(counters['benign_skipped'], 1)
+                self.assertEqual(counters['benign_checked'], 1)
+
+    def test_blacklist_engine(self):
+        e = shadowd.connector.BlacklistEngine([
+            {'rule': 'union\\s+select', 'impact': 8},
+            {'rule': "'\\s*or\\s", 'impact': 4},
+            {'rule': '<script', 'impact': 12},
+            {'rule': '(invalid', 'impact': 100}
+        ])
+
+        self.assertIsNotNone(e.prefilter)
+        self.assertEqual(e.score('foo'), 0)
+        self.assertEqual(e.score("' OR 1 UNION SELECT"), 12)
+        self.assertEqual(e.scan({'GET|a': 'foo', 'GET|b': '<SCRIPT>', 'GET|c': "' or 1", 'GET|d': None}, 10), (['GET|b'], 12))
+
+        # Backreferences can not be combined into a single regex.
+        e = shadowd.connector.BlacklistEngine([{'rule': '(a)\\1', 'impact': 1}])
+        self.assertIsNone(e.prefilter)
+        self.assertEqual(e.score('aa'), 1)
+
+    def test_start_blacklist(self):
+        handle, filters = tempfile.mkstemp(suffix='.json')
+        with os.fdopen(handle, 'w') as f:
+            json.dump([{'rule': '<script', 'impact': 12}, {'rule': 'union\\s+select', 'impact': 8}], f)
+
+        class DefusedInput(DummyInput):
+            def gather_input(self):
+                self.reset_input()
+                self.add_input('GET|foo', self.value)
+
+            def defuse_input(self, threats):
+                self.threats = threats
+                return True
+
+        with write_config({
+            'profile': 1,
+            'key': 'foo',
+            'port': 1,
+            'blacklist_filters': filters,
+            'blacklist_threshold': 8,
+            'blacklist_critical': 12
+        }):
+            try:
+                shadowd.connector.statistics.reset()
+
+                i = DefusedInput()
+                i.value = '<script>'
+                self.assertEqual(shadowd.connector.Connector().start(i, DummyOutput()), 'error')
+                self.assertFalse(hasattr(i, 'threats'))
+
+                # The threat is removed before the connection to the shadowd server fails.
+                i = DefusedInput()
+                i.value = '1 union select 2'
+                self.assertEqual(shadowd.connector.Connector().start(i, DummyOutput()), 'error')
+                self.assertEqual(i.threats, ['GET|foo'])
+
+                counters = shadowd.connector.statistics.get()
+                self.assertEqual(counters['blacklist_critical'], 1)
+                self.assertEqual(counters['blacklist_defused'], 1)
+            finally:
+                os.remove(filters)
+
+    def test_verdict_cache(self):
+        c = shadowd.connector.VerdictCache(2, 60)
+        input = {'GET|foo': 'bar', 'GET|bar': 'baz', 'COOKIE|session': 'abc'}
+
+        fields, digests, omitted, saved = c.select(input, 1, 'foo', 1)
+        self.assertEqual((fields, omitted, saved), (input, 0, 0))
+        c.add(digests.values())
+
+        # Only the two most recent digests are kept.
+        fields, digests, omitted, saved = c.select(input, 1, 'foo', 1)
+        self.assertEqual(fields, {'GET|foo': 'bar'})
+        self.assertEqual(omitted, 2)
+        self.assertEqual(saved, len('"GET|bar": "baz", "COOKIE|session": "abc", '))
+
+        self.assertEqual(c.select(input, 1, 'foo', 1, complete=True)[0], input)
+
+        # Verdicts depend on the profile and the caller.
+        self.assertEqual(c.select(input, 2, 'foo', 1)[0], input)
+        self.assertEqual(c.select(input, 1, 'admin', 1)[0], input)
+        self.assertEqual(c.select(input, 1, 'foo', 1)[0], {'GET|foo': 'bar'})
+
+        self.assertEqual(c.select(input, 1, 'foo', 2)[0], input)
+
+        c = shadowd.connector.VerdictCache(10, 0)
+        c.add(c.select(input, 1, 'foo', 1)[1].values())
+        self.assertEqual(c.select(input, 1, 'foo', 1)[0], input)
+
+    def test_start_verdict_cache(self):
+        with shadowd.tests.server.StandInServer(respond=shadowd.tests.server.respond_attack, unix=False) as server:
+            class CookieInput(DummyInput):
+                def gather_input(self):
+                    self.reset_input()
+                    self.add_input('GET|foo', self.value)
+                    self.add_input('COOKIE|session', 'abc')
+
+                def defuse_input(self, threats):
+                    self.threats = threats
+                    return True
+
+            with write_config({
+                'profile': 1,
+                'key': 'foo',
+                'port': server.port,
+                'verdict_cache_size': 100,
+                'verdict_cache_complete': 0
+            }):
+                shadowd.connector.statistics.reset()
+
+                for value in ('bar', 'bar', 'attack', 'attack'):
+                    i = CookieInput()
+                    i.value = value
+                    self.assertTrue(shadowd.connector.Connector().start(i, DummyOutput()))
+
+                self.assertEqual([json.loads(request)['input'] for request in server.requests], [
+                    {'GET|foo': 'bar', 'COOKIE|session': 'abc'},
+                    {},
+                    {'GET|foo': 'attack'},
+                    {'GET|foo': 'attack'}
+                ])
+                self.assertEqual(i.threats, ['GET|foo'])
+                self.assertEqual(shadowd.connector.statistics.get()['verdict_cache_fields'], 4)
+
+    def test_flight_recorder(self):
+        r = shadowd.connector.FlightRecorder(2)
+        for index in range(3):
+            r.capture({'duration': index})
+
+        self.assertEqual(r.get(), [{'duration': 1}, {'duration': 2}])
+
+        handle, file = tempfile.mkstemp(suffix='.json')
+        os.close(handle)
+
+        try:
+            r.dump(file)
+            with open(file, 'r') as f:
+                self.assertEqual(json.load(f), r.get())
+        finally:
+            os.remove(file)
+
+    def test_start_slow_check(self):
+        with shadowd.tests.server.StandInServer(unix=False) as server:
+            with write_config({
+                'profile': 1,
+                'key': 'foo',
+                'port': server.port,
+                'slow_check_threshold': 0,
+                'slow_check_size': 7
+            }):
+                i = DummyInput()
+                self.assertTrue(shadowd.connector.Connector().start(i, DummyOutput()))
+
+                check = shadowd.connector.get_flight_recorder(7).get()[-1]
+                self.assertEqual(sorted(check['phases']), ['finish', 'gather', 'prepare', 'send'])
+                self.assertEqual(check['fields'], 1)
+                self.assertEqual(check['largest'], [['GET|foo', 3]])
+                self.assertEqual(check['payload'], len(server.requests[0]) + len('1\n') + 64 + 2)
+                self.assertEqual(check['server'], '127.0.0.1:' + str(server.port))
+                self.assertEqual(check['verdict'], 'ok')
+
+    def test_check_many(self):
+        with shadowd.tests.server.StandInServer(respond=shadowd.tests.server.respond_attack, unix=False) as server:
+            with write_config({'profile': 1, 'key': 'foo', 'port': server.port}):
+                records = [
+                    ('foo', '/foo', {'GET|foo': 'bar'}),
+                    ('foo', '/foo', {'GET|foo': 'attack'}),
+                    ('foo', '/foo', {'GET|foo': {1, 2}})
+                ] * 10
+
+                results = list(shadowd.connector.Connector().check_many(iter(records), concurrency=4))
+                self.assertEqual(sorted(result[0] for result in results), list(range(30)))
+
+                for index, status, error in results:
+                    if index % 3 == 0:
+                        self.assertEqual(status, {'attack': False})
+                    elif index % 3 == 1:
+                        self.assertEqual(status['threats'], ['GET|foo'])
+                    else:
+                        self.assertIsNone(status)
+                        self.assertIsInstance(error, TypeError)
+
+                # Records are read lazily.
+                consumed = []
+                generator = shadowd.connector.Connector().check_many(
+                    (consumed.append(index) or records[0] for index in range(1000)), concurrency=2
+                )
+                next(generator)
+                generator.close()
+                self.assertLessEqual(len(consumed), 5)
+
+    def test_check_many_ignore(self):
+        handle, ignore = tempfile.mkstemp(suffix='.json')
+
+        with os.fdopen(handle, 'w') as f:
+            json.dump([{'path': 'POST|password'}], f)
+
+        with shadowd.tests.server.StandInServer(unix=False) as server:
+            try:
+                with write_config({'profile': 1, 'key': 'foo', 'port': server.port, 'ignore': ignore}):
+                    records = [('foo', '/foo', {'GET|foo': 'bar', 'POST|password': 'baz'})]
+
+                    results = list(shadowd.connector.Connector().check_many(records))
+                    self.assertEqual(results, [(0, {'attack': False}, None)])
+                    self.assertEqual(json.loads(server.requests[0])['input'], {'GET|foo': 'bar'})
+
+                    # The records of the caller keep the ignored fields.
+                    self.assertEqual(records[0][2], {'GET|foo': 'bar', 'POST|password': 'baz'})
+            finally:
+                os.remove(ignore)
+
+    def test_preconnect(self):
+        with shadowd.tests.server.StandInServer(unix=False) as server:
+            pool = shadowd.connector.CheckPool(1)
+
+            c = shadowd.connector.Connection()
+            c.preconnect('127.0.0.1', server.port, None, pool)
+            c.pending[1].result()
+
+            i = DummyInput()
+            i.gather_input()
+            i.gather_hashes()
+            self.assertEqual(c.send(i, '127.0.0.1', server.port, 1, 'foo', None), {'attack': False})
+            self.assertIsNotNone(c.connect_time)
+            self.assertIsNotNone(c.connect_wait)
+            self.assertIsNone(c.pending)
+
+            # Unused connections are closed.
+            c = shadowd.connector.Connection()
+            c.preconnect('127.0.0.1', server.port, None, pool)
+            connection_socket = c.pending[1].result()
+            c.close()
+            self.assertIsNone(c.pending)
+            self.assertEqual(connection_socket.fileno(), -1)
+            self.assertEqual(len(server.requests), 1)
+
+    def test_start_preconnect(self):
+        with shadowd.tests.server.StandInServer(unix=False) as server:
+            with write_config({
+                'profile': 1,
+                'key': 'foo',
+                'port': server.port,
+                'preconnect': 1,
+                'slow_check_threshold': 0,
+                'slow_check_size': 8
+            }):
+                self.assertTrue(shadowd.connector.Connector().start(DummyInput(), DummyOutput()))
+                self.assertEqual(len(server.requests), 1)
+
+                check = shadowd.connector.get_flight_recorder(8).get()[-1]
+                self.assertEqual(check['verdict'], 'ok')
+                self.assertIn('connect', check)
+
+    def test_start_preconnect_local(self):
+        with shadowd.tests.server.StandInServer(unix=False) as server:
+            with write_config({
+                'profile': 1,
+                'key': 'foo',
+                'port': server.port,
+                'preconnect': 1,
+                'benign_get': '[a-z]{0,3}',
+                'benign_sample': 0
+            }):
+                # Requests that are finished locally do not connect at all.
+                self.assertTrue(shadowd.connector.Connector().start(DummyInput(), DummyOutput()))
+                self.assertEqual(server.connections, 0)
+
+    def test_sign(self):
+        c = shadowd.connector.Connection()
+
+        self.assertEqual(c.sign('foo', 'bar'), 'f9320baf0249169e73850cd6156ded0106e2bb6ad8cab01b7bbbebe6d1065317')
+        self.assertEqual(c.sign('foo', 'bar'), 'f9320baf0249169e73850cd6156ded0106e2bb6ad8cab01b7bbbebe6d1065317')
+
+    def test_profile_router(self):
+        r = shadowd.connector.ProfileRouter([
+            {'host': 'foo.org', 'profile': 1, 'key': 'foo'},
+            {'host': 'foo.org', 'path': '/admin/', 'profile': 2, 'key': 'bar'},
+            {'path': '/api/', 'profile': 3, 'key': 'baz'},
+            {'caller': 'cron', 'profile': 4, 'key': 'qux'}
+        ])
+
+        self.assertEqual(r.lookup('foo.org', '/', 'foo'), (1, 'foo'))
+        self.assertEqual(r.lookup('FOO.org:8080', '/admin/foo', 'foo'), (2, 'bar'))
+        self.assertEqual(r.lookup('foo.org', '/api/foo', 'foo'), (1, 'foo'))
+        self.assertEqual(r.lookup('bar.org', '/api/foo', 'foo'), (3, 'baz'))
+        self.assertEqual(r.lookup(None, '/foo', 'cron'), (4, 'qux'))
+        self.assertIsNone(r.lookup('bar.org', '/foo', 'foo'))
+
+    def test_upload_digester(self):
+        d = shadowd.connector.UploadDigester('sha256', 1000, 0, 2, 5)
+        digest = hashlib.sha256(b'%PDF-foo').hexdigest()
+
+        stream = io.BytesIO(b'%PDF-foo')
+        stream.seek(2)
+
+        with tempfile.TemporaryFile() as f:
+            f.write(b'%PDF-foo')
+            f.seek(3)
+
+            results = d.run([('FILES|a', b'%PDF-foo'), ('FILES|b', stream), ('FILES|c', f), ('FILES|d', b'x' * 1001)])
+
+            self.assertEqual(sorted(results), [
+                ('FILES|a', digest, 8, 'application/pdf'),
+                ('FILES|b', digest, 8, 'application/pdf'),
+                ('FILES|c', digest, 8, 'application/pdf')
+            ])
+            self.assertEqual(f.tell(), 3)
+
+        # The buffer of the stream is released again.
+        self.assertEqual(stream.tell(), 2)
+        stream.write(b'bar')
+
+    def test_upload_digester_timeout(self):
+        d = shadowd.connector.UploadDigester('sha256', None, 0, 1, 0.05)
+        calls = []
+        digest_file = d.digest_file
+        d.digest_file = lambda fileno, size: calls.append(fileno) or digest_file(fileno, size)
+
+        with tempfile.TemporaryFile() as f:
+            f.write(b'%PDF-foo')
+            f.flush()
+
+            # The only worker is busy, so the job is cancelled after the timeout.
+            blocker = d.get_pool().submit(time.sleep, 0.2)
+            self.assertEqual(d.run([('FILES|a', f)]), [])
+
+        blocker.result()
+        d.pool.shutdown(wait=True)
+        self.assertEqual(calls, [])
+
+    def test_gather_uploads(self):
+        i = shadowd.connector.Input()
+        i.upload_digester = shadowd.connector.UploadDigester('md5', None, 1048576, 1, 5)
+        i.reset_input()
+
+        i.add_uploads('FILES|foo', [b'bar1', b'bar2'])
+        i.gather_uploads()
+
+        input = i.get_input()
+        self.assertEqual(input['FILEHASH|foo|0'], hashlib.md5(b'bar1').hexdigest())
+        self.assertEqual(input['FILESIZE|foo|1'], '4')
+        self.assertEqual(input['FILETYPE|foo|1'], 'application/octet-stream')
+
+    def test_hash_index(self):
+        handle, file = tempfile.mkstemp(suffix='.py')
+
+        with os.fdopen(handle, 'w') as f:
+            f.write('def view():\n    pass\n')
+
+        try:
+            spec = importlib.util.spec_from_file_location('shadowd_test_view', file)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+
+            h = shadowd.connector.HashIndex(0)
+            h.add('foo', module.view)
+
+            with open(file, 'rb') as f:
+                self.assertEqual(h.lookup('foo'), {'sha256': hashlib.sha256(f.read()).hexdigest()})
+
+            self.assertEqual(h.lookup('bar'), {})
+
+            # Modified files are hashed again.
+            with open(file, 'a') as f:
+                f.write('# foo\n')
+
+            os.utime(file, (time.time() + 10, time.time() + 10))
+
+            with open(file, 'rb') as f:
+                self.assertEqual(h.lookup('foo'), {'sha256': hashlib.sha256(f.read()).hexdigest()})
+
+            # A route that is added by another thread is only visible with the hash of its file.
+            h = shadowd.connector.HashIndex(10)
+            hash_file = h.hash_file
+            h.hash_file = lambda file: time.sleep(0.2) or hash_file(file)
+
+            thread = threading.Thread(target=h.add, args=('foo', module.view))
+            thread.start()
+            time.sleep(0.05)
+
+            with open(file, 'rb') as f:
+                self.assertEqual(h.lookup('foo', module.view), {'sha256': hashlib.sha256(f.read()).hexdigest()})
+
+            thread.join()
+        finally:
+            os.remove(file)
+
+    def test_add_json(self):
+        i = shadowd.connector.Input()
+        i.json_max_depth = 4
+        i.reset_input()
+
+        i.add_json({'user': {'addresses': [{'street': 'foo', 'geo': {'lat': 1.5}}], 'a|b': True, 'c': None}})
+
+        self.assertEqual(i.get_input(), {
+            'JSON|user|addresses|0|street': 'foo',
+            'JSON|user|addresses|0|geo': '{"lat": 1.5}',
+            'JSON|user|a\\|b': 'true',
+            'JSON|user|c': 'null'
+        })
+
+        # Values after the maximum number of fields are still sent, but not flattened anymore.
+        i.json_max_fields = 3
+        i.reset_input()
+        i.add_json({'a': 1, 'b': 2, 'c': 3, 'd': {'evil': 'foo'}, 'e': 'bar'})
+        self.assertEqual(i.get_input(), {
+            'JSON|a': '1',
+            'JSON|b': '2',
+            'JSON|c': '3',
+            'JSON|d': '{"evil": "foo"}',
+            'JSON|e': 'bar'
+        })
+
+        # The input budget limits the number of fields and flags the rest.
+        i.budget = shadowd.connector.InputBudget('truncate', 3, None, None, None, None)
+        i.reset_input()
+
+        with self.assertRaises(shadowd.connector.InputBudgetExceeded):
+            i.add_json([1, 2, 3, 4])
+
+        self.assertEqual(i.budget_exceeded, 'fields')
+
+    def test_defuse_json(self):
+        i = shadowd.connector.Input()
+        i.json = {'user': {'addresses': [{'street': 'foo'}], 'a|b': 'bar'}}
+
+        self.assertTrue(i.defuse_json(i.split_path('JSON|user|addresses|0|street')))
+        self.assertTrue(i.defuse_json(i.split_path('JSON|user|a\\|b')))
+        self.assertFalse(i.defuse_json(i.split_path('JSON|user|foo')))
+        self.assertFalse(i.defuse_json(i.split_path('JSON|user|addresses|1|street')))
+        self.assertEqual(i.json, {'user': {'addresses': [{'street': ''}], 'a|b': ''}})
+
+    def test_remove_ignored(self):
+        handle, file = tempfile.mkstemp(suffix='.json')
+
+        with os.fdopen(handle, 'w') as f:
+            json.dump([
+                {'path': 'POST|password'},
+                {'caller': 'foo', 'path': 'GET|token'},
+                {'caller': 'bar'}
+            ], f)
+
+        try:
+            i = DummyInput()
+            i.gather_input()
+            i.input.update({'POST|password': 'foo', 'GET|token': 'bar'})
+            i.remove_ignored(file)
+            self.assertEqual(i.get_input(), {'GET|foo': 'bar'})
+
+            i.get_caller = lambda: 'baz'
+            i.gather_input()
+            i.input.update({'POST|password': 'foo', 'GET|token': 'bar'})
+            i.remove_ignored(file)
+            self.assertEqual(i.get_input(), {'GET|foo': 'bar', 'GET|token': 'bar'})
+
+            # Missing paths are skipped.
+            i.gather_input()
+            i.remove_ignored(file)
+            self.assertEqual(i.get_input(), {'GET|foo': 'bar'})
+
+            i.get_caller = lambda: 'bar'
+            i.remove_ignored(file)
+            self.assertEqual(i.get_input(), {})
+        finally:
+            os.remove(file)
+
+    def test_resolver(self):
+        r = shadowd.connector.Resolver(60)
+
+        addresses = r.resolve('127.0.0.1', 9115)
+        self.assertEqual(addresses[0][4], ('127.0.0.1', 9115))
+        self.assertIs(r.resolve('127.0.0.1', 9115), addresses)
+
+        r.forget('127.0.0.1', 9115)
+        self.assertIsNot(r.resolve('127.0.0.1', 9115), addresses)
+
+    def test_warmup(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+
+        try:
+            with write_config({
+                'profile': 1,
+                'key': 'foo',
+                'port': server.getsockname()[1]
+            }):
+                shadowd.connector.Connector().warmup(connect=True)
+
+                client, _ = server.accept()
+                client.close()
+        finally:
+            server.close()
+
+    def test_reinitialize(self):
+        d = shadowd.connector.UploadDigester('sha256', None, 0, 1, 5)
+        d.get_pool()
+        lock = shadowd.connector.compiled_lock
+
+        shadowd.connector.reinitialize()
+
+        self.assertIsNone(d.pool)
+        self.assertIsNot(shadowd.connector.compiled_lock, lock)
+
+    def test_send(self):
+        with shadowd.tests.server.StandInServer(respond=shadowd.tests.server.respond_attack) as server:
+            c = shadowd.connector.Connection()
+
+            i = DummyInput()
+            i.gather_input()
+            i.gather_hashes()
+            self.assertEqual(c.send(i, '127.0.0.1', server.port, 1, 'foo', None), {'attack': False})
+
+            i.input['GET|foo'] = 'attack'
+            self.assertEqual(c.send(i, '127.0.0.1', server.port, 1, 'foo', None), {
+                'attack': True,
+                'critical': False,
+                'threats': ['GET|foo']
+            })
+
+            with self.assertRaises(Exception):
+                c.send(i, '127.0.0.1', server.port, 1, 'bar', None)
+
+    @unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'requires unix domain sockets')
+    def test_send_unix(self):
+        with shadowd.tests.server.StandInServer() as server:
+            with write_config({
+                'profile': 1,
+                'key': 'foo',
+                'host': 'unix:' + server.unix_path,
+                'tcp_nodelay': 1,
+                'tcp_fastopen': 1,
+                'sndbuf': 65536,
+                'connect_timeout': 1
+            }):
+                i = DummyInput()
+                self.assertTrue(shadowd.connector.Connector().start(i, DummyOutput()))
+                self.assertEqual(len(server.requests), 1)
+
+    def test_start_tcp_options(self):
+        with shadowd.tests.server.StandInServer(unix=False) as server:
+            with write_config({
+                'profile': 1,
+                'key': 'foo',
+                'port': server.port,
+                'tcp_nodelay': 1,
+                'tcp_fastopen': 1,
+                'sndbuf': 65536,
+                'rcvbuf': 65536,
+                'connect_timeout': 1
+            }):
+                i = DummyInput()
+                self.assertTrue(shadowd.connector.Connector().start(i, DummyOutput()))
+                self.assertEqual(len(server.requests), 1)
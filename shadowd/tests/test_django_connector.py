@@ -14,16 +14,45 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
+import os
+import asyncio
+import hashlib
 import unittest
+import shadowd.connector
 import shadowd.django_connector
+import shadowd.tests.server
+from shadowd.tests.test_connector import write_config
 import django.http
 import django.conf
+import django.urls
+
+
+def view(request):
+    return django.http.HttpResponse('foo')
+
+urlpatterns = [
+    django.urls.path('foo/', view),
+]
+
+class OtherUrls:
+    urlpatterns = [
+        django.urls.path('bar/', shadowd.tests.server.respond_ok),
+    ]
 
 
 class TestDjangoConnector(unittest.TestCase):
     @classmethod
     def setUpClass(self):
-        django.conf.settings.configure(DEBUG=True)
+        django.conf.settings.configure(
+            DEBUG=True,
+            ROOT_URLCONF=__name__,
+            SHADOWD_ROUTES=[
+                ('/static/', 'skip'),
+                ('^/health$', 'skip'),
+                ('/api/', 'observe', {'profile': 2, 'key': 'bar'}),
+                ('/read/', 'optimistic')
+            ]
+        )
 
     def test_get_input(self):
         r = django.http.HttpRequest()
@@ -86,3 +115,141 @@ class TestDjangoConnector(unittest.TestCase):
 
         threats2 = ['FILES|foo']
         self.assertFalse(i.defuse_input(threats2))
+
+    def test_middleware(self):
+        def get_response(request):
+            return django.http.HttpResponse('foo')
+
+        m = shadowd.django_connector.ShadowdMiddleware(get_response)
+
+        self.assertEqual(m.routes.lookup('/static/foo.css'), ('skip', {}))
+        self.assertEqual(m.routes.lookup('/api/foo'), ('observe', {'profile': 2, 'key': 'bar'}))
+        self.assertEqual(m.routes.lookup('/healthy'), ('protect', {}))
+
+        r = django.http.HttpRequest()
+        r.path_info = '/static/foo.css'
+        self.assertEqual(m(r).content, b'foo')
+
+        # The connector is not configured, so protected routes fail.
+        r = django.http.HttpRequest()
+        r.path_info = '/foo'
+        self.assertEqual(m(r).status_code, 500)
+
+    def test_middleware_async(self):
+        async def get_response(request):
+            return django.http.HttpResponse('foo')
+
+        m = shadowd.django_connector.ShadowdMiddleware(get_response)
+
+        r = django.http.HttpRequest()
+        r.path_info = '/health'
+        self.assertEqual(asyncio.run(m(r)).content, b'foo')
+
+        r = django.http.HttpRequest()
+        r.path_info = '/foo'
+        self.assertEqual(asyncio.run(m(r)).status_code, 500)
+
+    def test_middleware_optimistic(self):
+        calls = []
+
+        async def get_response(request):
+            calls.append(request.GET.get('foo'))
+            return django.http.HttpResponse('foo')
+
+        def respond(profile, data):
+            if data['input'].get('GET|foo') == 'attack':
+                return {'status': shadowd.connector.STATUS_CRITICAL_ATTACK}
+
+            return {'status': shadowd.connector.STATUS_OK}
+
+        m = shadowd.django_connector.ShadowdMiddleware(get_response)
+
+        with shadowd.tests.server.StandInServer(respond=respond, unix=False) as server:
+            with write_config({'profile': 1, 'key': 'foo', 'port': server.port}):
+                r = django.http.HttpRequest()
+                r.method = 'GET'
+                r.path_info = '/read/foo'
+                r.GET = django.http.QueryDict('foo=bar')
+                self.assertEqual(asyncio.run(m(r)).content, b'foo')
+
+                # The view already ran, but its response is replaced.
+                r.GET = django.http.QueryDict('foo=attack')
+                self.assertEqual(asyncio.run(m(r)).status_code, 500)
+                self.assertEqual(calls, ['bar', 'attack'])
+
+                # Unsafe methods wait for the verdict.
+                r.method = 'POST'
+                self.assertEqual(asyncio.run(m(r)).status_code, 500)
+                self.assertEqual(calls, ['bar', 'attack'])
+
+    def test_middleware_optimistic_rerun(self):
+        calls = []
+
+        def get_response(request):
+            calls.append(request.GET.get('foo'))
+            return django.http.HttpResponse(request.GET.get('foo'))
+
+        m = shadowd.django_connector.ShadowdMiddleware(get_response)
+
+        with shadowd.tests.server.StandInServer(respond=shadowd.tests.server.respond_attack, unix=False) as server:
+            with write_config({'profile': 1, 'key': 'foo', 'port': server.port}):
+                r = django.http.HttpRequest()
+                r.method = 'GET'
+                r.path_info = '/read/foo'
+                r.GET = django.http.QueryDict('foo=bar')
+                self.assertEqual(m(r).content, b'bar')
+                self.assertEqual(calls, ['bar'])
+
+                # The view runs again with the defused input.
+                r.GET = django.http.QueryDict('foo=attack')
+                self.assertEqual(m(r).content, b'')
+                self.assertEqual(calls, ['bar', 'attack', ''])
+
+    def test_gather_hashes(self):
+        r = django.http.HttpRequest()
+        r.path_info = '/foo/'
+
+        i = shadowd.django_connector.InputDjango(r)
+        i.set_config(shadowd.connector.Config())
+        i.gather_hashes()
+        self.assertEqual(i.get_hashes(), {})
+
+        i.config.get = lambda key, required = False, default = None: '1' if key == 'integrity' else default
+        i.gather_hashes()
+
+        with open(__file__.replace('.pyc', '.py'), 'rb') as f:
+            self.assertEqual(i.get_hashes(), {'sha256': hashlib.sha256(f.read()).hexdigest()})
+
+        # The URLconf of the request is used if it is set.
+        r.path_info = '/bar/'
+        i.gather_hashes()
+        self.assertEqual(i.get_hashes(), {})
+
+        r.urlconf = OtherUrls
+        i.gather_hashes()
+
+        with open(shadowd.tests.server.__file__, 'rb') as f:
+            self.assertEqual(i.get_hashes(), {'sha256': hashlib.sha256(f.read()).hexdigest()})
+
+    def test_warmup_hashes(self):
+        with write_config({'profile': 1, 'key': 'foo', 'integrity': 1, 'integrity_interval': 5}):
+            shadowd.connector.Connector().warmup()
+            self.assertIn(('integrity_django', 5.0), shadowd.connector.compiled_cache)
+
+    def test_json(self):
+        r = django.http.HttpRequest()
+        r.META = {'CONTENT_TYPE': 'application/json'}
+        r._body = b'{"foo": ["bar", "baz"]}'
+
+        i = shadowd.django_connector.InputDjango(r)
+        i.json_input = True
+        i.gather_input()
+
+        input = i.get_input()
+        self.assertEqual(input['JSON|foo|0'], 'bar')
+        self.assertEqual(input['JSON|foo|1'], 'baz')
+        self.assertIs(r.shadowd_json, i.json)
+
+        self.assertTrue(i.defuse_input(['JSON|foo|1']))
+        self.assertEqual(r.body, b'{"foo": ["bar", ""]}')
+        self.assertEqual(r.read(), b'{"foo": ["bar", ""]}')
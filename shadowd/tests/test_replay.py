@@ -0,0 +1,101 @@
+# Shadow Daemon -- Web Application Firewall
+#
+# Copyright (C) 2014-2022 Hendrik Buchwald <hb@zecure.org>
+#
+# This file is part of Shadow Daemon. Shadow Daemon is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import tempfile
+import unittest
+import shadowd.connector
+import shadowd.replay
+import shadowd.tests.server
+
+
+class TestReplay(unittest.TestCase):
+    def setUp(self):
+        handle, self.file = tempfile.mkstemp(suffix='.gz')
+        os.close(handle)
+        os.remove(self.file)
+
+    def tearDown(self):
+        if os.path.exists(self.file):
+            os.remove(self.file)
+
+    def record(self, values):
+        recorder = shadowd.connector.Recorder(self.file, 1)
+
+        for value in values:
+            recorder.write(shadowd.connector.StaticInput('127.0.0.1', 'foo', '/foo', {'GET|foo': value}))
+
+        recorder.close()
+
+    def test_record(self):
+        self.record(['bar', 'baz'])
+
+        # Appending starts a new gzip member.
+        self.record(['qux'])
+
+        records = list(shadowd.connector.read_records(self.file))
+        self.assertEqual([record['input']['GET|foo'] for record in records], ['bar', 'baz', 'qux'])
+        self.assertEqual(records[0]['caller'], 'foo')
+        self.assertEqual(records[0]['resource'], '/foo')
+        self.assertEqual(records[0]['hashes'], {})
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'requires fork')
+    def test_record_fork(self):
+        recorder = shadowd.connector.Recorder(self.file, 100)
+        recorder.write(shadowd.connector.StaticInput('127.0.0.1', 'foo', '/foo', {'GET|foo': 'bar'}))
+
+        pid = os.fork()
+        if pid == 0:
+            # The child appends its own records once.
+            recorder.write(shadowd.connector.StaticInput('127.0.0.1', 'foo', '/foo', {'GET|foo': 'baz'}))
+            recorder.close()
+            del recorder
+            os._exit(0)
+
+        os.waitpid(pid, 0)
+        recorder.write(shadowd.connector.StaticInput('127.0.0.1', 'foo', '/foo', {'GET|foo': 'qux'}))
+        recorder.close()
+
+        records = list(shadowd.connector.read_records(self.file))
+        self.assertEqual(sorted(record['input']['GET|foo'] for record in records), ['bar', 'baz', 'qux'])
+
+    def test_replay(self):
+        self.record(['bar', 'attack', 'baz', 'bar'])
+
+        with shadowd.tests.server.StandInServer(respond=shadowd.tests.server.respond_attack, unix=False) as server:
+            options = {
+                'host':        '127.0.0.1',
+                'port':        server.port,
+                'profile':     1,
+                'key':         'foo',
+                'ssl':         None,
+                'client_ip':   '127.0.0.1',
+                'rate':        1000,
+                'concurrency': 2
+            }
+
+            report = shadowd.replay.replay(self.file, options)
+            self.assertEqual(report['requests'], 4)
+            self.assertEqual(report['verdicts'], {'ok': 3, 'attack': 1})
+            self.assertGreater(report['latency']['p99'], 0)
+
+            report = shadowd.replay.replay(self.file, options, processes=2, limit=3)
+            self.assertEqual(report['requests'], 3)
+            self.assertEqual(report['verdicts'], {'ok': 2, 'attack': 1})
+
+            options['key'] = 'bar'
+            report = shadowd.replay.replay(self.file, options, limit=1)
+            self.assertEqual(report['verdicts'], {'error': 1})
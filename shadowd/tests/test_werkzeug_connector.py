@@ -14,6 +14,7 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
+import io
 import sys
 import unittest
 import shadowd.werkzeug_connector
@@ -83,6 +84,10 @@ class TestWerkzeugConnector(unittest.TestCase):
         self.assertIn('FILES|foo|1', input)
         self.assertEqual(input['FILES|foo|1'], 'bar2')
 
+        i.lazy_input = True
+        i.gather_input()
+        self.assertEqual(dict(i.get_input().items()), input)
+
     def test_defuse_input(self):
         environ = {
             'wsgi.input': sys.stdin,
@@ -110,3 +115,28 @@ class TestWerkzeugConnector(unittest.TestCase):
         self.assertIn('HTTP_FOO', r.environ)
         self.assertEqual(r.environ['HTTP_FOO'], '')
         self.assertNotIn('foo', r.files)
+
+    def test_json(self):
+        body = b'{"foo": ["bar", "baz"]}'
+        environ = {
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'CONTENT_TYPE': 'application/json',
+            'CONTENT_LENGTH': str(len(body)),
+            'REQUEST_METHOD': 'POST'
+        }
+        r = werkzeug.wrappers.Request(environ)
+
+        i = shadowd.werkzeug_connector.InputWerkzeug(r)
+        i.json_input = True
+        i.gather_input()
+
+        input = i.get_input()
+        self.assertNotIn('DATA|raw', input)
+        self.assertEqual(input['JSON|foo|0'], 'bar')
+        self.assertEqual(input['JSON|foo|1'], 'baz')
+        self.assertIs(r.get_json(), i.json)
+
+        self.assertTrue(i.defuse_input(['JSON|foo|1']))
+        self.assertEqual(r.get_json(), {'foo': ['bar', '']})
+        self.assertEqual(r.get_data(), b'{"foo": ["bar", ""]}')
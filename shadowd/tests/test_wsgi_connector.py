@@ -0,0 +1,237 @@
+# Shadow Daemon -- Web Application Firewall
+#
+# Copyright (C) 2014-2022 Hendrik Buchwald <hb@zecure.org>
+#
+# This file is part of Shadow Daemon. Shadow Daemon is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import io
+import os
+import unittest
+import shadowd.connector
+import shadowd.wsgi_connector
+import shadowd.tests.server
+from shadowd.tests.test_connector import write_config
+
+
+MULTIPART = (
+    b'--xyz\r\n'
+    b'Content-Disposition: form-data; name="foo"\r\n\r\n'
+    b'bar\r\n'
+    b'--xyz\r\n'
+    b'Content-Disposition: form-data; name="upload"; filename="bar.txt"\r\n'
+    b'Content-Type: text/plain\r\n\r\n'
+    b'content\r\n'
+    b'--xyz--\r\n'
+)
+
+def create_environ(body = b'', content_type = '', **kwargs):
+    environ = {
+        'REQUEST_METHOD': 'POST',
+        'PATH_INFO': '/foo',
+        'QUERY_STRING': 'foo=bar',
+        'CONTENT_TYPE': content_type,
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.input': io.BytesIO(body),
+        'HTTP_COOKIE': 'foo=bar',
+        'HTTP_FOO': 'bar',
+        'foo': 'bar'
+    }
+    environ.update(kwargs)
+
+    return environ
+
+def create_input(environ):
+    i = shadowd.wsgi_connector.InputWSGI(environ)
+    i.set_config(shadowd.connector.Config())
+
+    return i
+
+class TestWsgiConnector(unittest.TestCase):
+    def test_get_input(self):
+        i = create_input(create_environ(b'foo=bar', 'application/x-www-form-urlencoded'))
+        i.gather_input()
+
+        input = i.get_input()
+        self.assertIn('GET|foo', input)
+        self.assertEqual(input['GET|foo'], 'bar')
+        self.assertIn('POST|foo', input)
+        self.assertEqual(input['POST|foo'], 'bar')
+        self.assertIn('COOKIE|foo', input)
+        self.assertEqual(input['COOKIE|foo'], 'bar')
+        self.assertIn('SERVER|HTTP_FOO', input)
+        self.assertEqual(input['SERVER|HTTP_FOO'], 'bar')
+        self.assertNotIn('SERVER|foo', input)
+
+        # The body can still be read by the application.
+        self.assertEqual(i.environ['wsgi.input'].read(), b'foo=bar')
+
+    def test_get_input_array(self):
+        i = create_input(create_environ(b'foo=bar1&foo=bar2', 'application/x-www-form-urlencoded',
+            QUERY_STRING='foo=bar1&foo=bar2'))
+        i.gather_input()
+
+        input = i.get_input()
+        self.assertIn('GET|foo|0', input)
+        self.assertEqual(input['GET|foo|0'], 'bar1')
+        self.assertIn('GET|foo|1', input)
+        self.assertEqual(input['GET|foo|1'], 'bar2')
+        self.assertIn('POST|foo|0', input)
+        self.assertEqual(input['POST|foo|0'], 'bar1')
+        self.assertIn('POST|foo|1', input)
+        self.assertEqual(input['POST|foo|1'], 'bar2')
+
+    def test_get_input_multipart(self):
+        i = create_input(create_environ(MULTIPART, 'multipart/form-data; boundary=xyz'))
+        i.gather_input()
+
+        input = i.get_input()
+        self.assertIn('POST|foo', input)
+        self.assertEqual(input['POST|foo'], 'bar')
+        self.assertIn('FILES|upload', input)
+        self.assertEqual(input['FILES|upload'], 'bar.txt')
+
+    def test_get_input_multipart_ambiguous(self):
+        bodies = [
+            # Line feeds without carriage returns.
+            MULTIPART.replace(b'\r\n', b'\n').replace(b'bar\n', b"' union select\n"),
+            # The delimiter inside of a value.
+            MULTIPART.replace(b'bar\r\n', b"foo--xyz' union select\r\n"),
+            # A bare carriage return before the delimiter.
+            MULTIPART.replace(b'bar\r\n', b"foo\r--xyz\r\n' union select\r\n"),
+            # No closing delimiter.
+            MULTIPART.replace(b'--xyz--\r\n', b"' union select"),
+        ]
+
+        for body in bodies:
+            i = create_input(create_environ(body, 'multipart/form-data; boundary=xyz'))
+            i.gather_input()
+
+            input = i.get_input()
+            self.assertNotIn('POST|foo', input)
+            self.assertIn("' union select", input['DATA|raw'])
+            self.assertEqual(i.environ['wsgi.input'].read(), body)
+
+    def test_get_input_multipart_spool(self):
+        body = MULTIPART.replace(b'content', b'x' * 200000)
+        i = create_input(create_environ(body, 'multipart/form-data; boundary=xyz'))
+        i.gather_input()
+
+        # Uploads stay in their own spooled files.
+        upload = i.parts[1][3]
+        self.assertEqual(upload.read(), b'x' * 200000)
+        self.assertEqual(i.get_input()['POST|foo'], 'bar')
+
+        self.assertTrue(i.defuse_input(['POST|foo']))
+        self.assertEqual(i.environ['wsgi.input'].read(), body.replace(b'bar\r\n', b'\r\n'))
+
+    def test_get_input_data(self):
+        i = create_input(create_environ(b'{"foo": "bar"}', 'application/json'))
+        i.gather_input()
+
+        input = i.get_input()
+        self.assertIn('DATA|raw', input)
+        self.assertEqual(input['DATA|raw'], '{"foo": "bar"}')
+
+    def test_defuse_input(self):
+        i = create_input(create_environ(b'foo=bar&baz=qux', 'application/x-www-form-urlencoded'))
+
+        threats = ['GET|foo', 'POST|foo', 'COOKIE|foo', 'SERVER|HTTP_FOO']
+        self.assertTrue(i.defuse_input(threats))
+        self.assertEqual(i.environ['QUERY_STRING'], 'foo=')
+        self.assertEqual(i.environ['HTTP_COOKIE'], 'foo=;')
+        self.assertEqual(i.environ['HTTP_FOO'], '')
+        self.assertEqual(i.environ['wsgi.input'].read(), b'foo=&baz=qux')
+        self.assertEqual(i.environ['CONTENT_LENGTH'], '12')
+
+    def test_defuse_input_utf8(self):
+        # Native strings contain the raw bytes of the request, see PEP 3333.
+        i = create_input(create_environ(
+            'name=J\u00fcrgen&foo=bar'.encode('utf-8'),
+            'application/x-www-form-urlencoded',
+            PATH_INFO='/f\u00fc\u00fc'.encode('utf-8').decode('latin-1'),
+            QUERY_STRING='q=\u00e4'.encode('utf-8').decode('latin-1')
+        ))
+        i.gather_input()
+
+        input = i.get_input()
+        self.assertEqual(input['POST|name'], 'J\u00fcrgen')
+        self.assertEqual(input['GET|q'], '\u00e4')
+        self.assertTrue(i.get_resource().startswith('/f%C3%BC%C3%BC?'))
+
+        self.assertTrue(i.defuse_input(['POST|foo']))
+        self.assertEqual(i.environ['wsgi.input'].read(), b'name=J%C3%BCrgen&foo=')
+        self.assertEqual(i.environ['QUERY_STRING'], 'q=%C3%A4')
+
+    def test_defuse_input_multipart(self):
+        i = create_input(create_environ(MULTIPART, 'multipart/form-data; boundary=xyz'))
+
+        threats = ['POST|foo', 'FILES|upload']
+        self.assertTrue(i.defuse_input(threats))
+
+        body = i.environ['wsgi.input'].read()
+        self.assertEqual(body, (
+            b'--xyz\r\n'
+            b'Content-Disposition: form-data; name="foo"\r\n\r\n'
+            b'\r\n'
+            b'--xyz--\r\n'
+        ))
+
+    def test_middleware(self):
+        def application(environ, start_response):
+            start_response('200 OK', [])
+            return [b'foo']
+
+        m = shadowd.wsgi_connector.ShadowdMiddleware(application, [('/static/', 'skip')])
+
+        # The connector is not configured, so protected routes fail.
+        status = []
+        self.assertEqual(m(create_environ(PATH_INFO='/static/foo.css'), lambda s, h: status.append(s)), [b'foo'])
+        self.assertEqual(m(create_environ(), lambda s, h: status.append(s)), [b'<h1>500 Internal Server Error</h1>'])
+        self.assertEqual(status, ['200 OK', '500 Internal Server Error'])
+
+    def test_middleware_optimistic(self):
+        calls = []
+
+        def application(environ, start_response):
+            calls.append(environ['QUERY_STRING'])
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return [b'foo', b'bar']
+
+        m = shadowd.wsgi_connector.ShadowdMiddleware(application, [('/', 'optimistic')])
+
+        with shadowd.tests.server.StandInServer(respond=shadowd.tests.server.respond_attack, unix=False) as server:
+            with write_config({'profile': 1, 'key': 'foo', 'port': server.port}):
+                status = []
+                environ = create_environ(REQUEST_METHOD='GET', HTTP_COOKIE='', HTTP_FOO='')
+                self.assertEqual(m(environ, lambda s, h: status.append(s)), [b'foo', b'bar'])
+                self.assertEqual(calls, ['foo=bar'])
+
+                # The first response is discarded and the application runs again with the defused input.
+                environ = create_environ(REQUEST_METHOD='GET', QUERY_STRING='foo=attack', HTTP_COOKIE='', HTTP_FOO='')
+                self.assertEqual(m(environ, lambda s, h: status.append(s)), [b'foo', b'bar'])
+                self.assertEqual(calls, ['foo=bar', 'foo=attack', 'foo='])
+                self.assertEqual(status, ['200 OK', '200 OK'])
+
+    def test_json(self):
+        i = create_input(create_environ(b'{"foo": {"bar": ["baz", 1]}}', 'application/json'))
+        i.json_input = True
+        i.gather_input()
+
+        input = i.get_input()
+        self.assertNotIn('DATA|raw', input)
+        self.assertEqual(input['JSON|foo|bar|0'], 'baz')
+        self.assertEqual(input['JSON|foo|bar|1'], '1')
+        self.assertIs(i.environ['shadowd.json'], i.json)
+
+        self.assertTrue(i.defuse_input(['JSON|foo|bar|0']))
+        self.assertEqual(i.environ['wsgi.input'].read(), b'{"foo": {"bar": ["", 1]}}')
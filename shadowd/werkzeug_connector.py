@@ -14,7 +14,9 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
-from .connector import Input, Output, Connector
+import json
+
+from .connector import Input, Output, Connector, UPLOAD_PATHS, is_json_mimetype
 from werkzeug.datastructures import ImmutableMultiDict
 
 
@@ -34,21 +36,17 @@ class InputWerkzeug(Input):
 
         return url[url.find(host) + len(host):]
 
-    def gather_input(self):
-        # Reset input.
-        self.input = {}
+    def get_host(self):
+        return self.request.host
 
+    def iterate_input(self):
         # Save GET parameters in input.
         get_input = self.request.args
         for key in get_input:
             path = 'GET|' + self.escape_key(key)
             values = get_input.getlist(key)
 
-            if len(values) > 1:
-                for index, value in enumerate(values):
-                    self.input[path + '|' + str(index)] = value
-            else:
-                self.input[path] = values[0]
+            yield from self.iterate_values(path, values)
 
         # Save POST parameters in input.
         post_input = self.request.form
@@ -56,25 +54,34 @@ class InputWerkzeug(Input):
             path = 'POST|' + self.escape_key(key)
             values = post_input.getlist(key)
 
-            if len(values) > 1:
-                for index, value in enumerate(values):
-                    self.input[path + '|' + str(index)] = value
-            else:
-                self.input[path] = values[0]
+            yield from self.iterate_values(path, values)
 
         # Save raw data in input. Has to be done AFTER post_input!
         data_raw = self.request.data
-        if data_raw:
-            self.input['DATA|raw'] = data_raw
+        tree = None
+
+        # Flatten JSON data and share the parsed tree with the application.
+        if data_raw and self.json_input and is_json_mimetype(self.request.mimetype):
+            tree = self.parse_json(data_raw)
+
+        if tree is not None:
+            self.request.environ['shadowd.json'] = tree
+
+            if hasattr(self.request, '_cached_json'):
+                self.request._cached_json = (tree, tree)
+
+            yield from self.iterate_json(tree)
+        elif data_raw:
+            yield ('DATA|raw', data_raw)
 
         # Save cookies in input.
         for key in self.request.cookies:
-            self.input['COOKIE|' + self.escape_key(key)] = self.request.cookies[key]
+            yield from self.iterate_cookie(key, self.request.cookies[key])
 
         # Save headers in input.
         for key in self.request.environ:
             if key[:5] == 'HTTP_':
-                self.input['SERVER|' + self.escape_key(key)] = self.request.environ[key]
+                yield from self.iterate_header(key, self.request.environ[key])
 
         # Save the file names of uploads.
         files_input = self.request.files
@@ -82,11 +89,8 @@ class InputWerkzeug(Input):
             path = 'FILES|' + self.escape_key(key)
             values = files_input.getlist(key)
 
-            if len(values) > 1:
-                for index, value in enumerate(values):
-                    self.input[path + '|' + str(index)] = value.filename
-            else:
-                self.input[path] = values[0].filename
+            yield from self.iterate_values(path, [value.filename for value in values])
+            self.add_uploads(path, [value.stream for value in values])
 
     def defuse_input(self, threats):
         # Get the input and create copy to make it mutable.
@@ -94,6 +98,7 @@ class InputWerkzeug(Input):
         post_input = self.request.form.copy()
         cookies_input = self.request.cookies.copy()
         files_input = self.request.files.copy()
+        json_changed = False
 
         # Remove threats.
         for path in threats:
@@ -124,11 +129,13 @@ class InputWerkzeug(Input):
                     post_input.setlist(key, post_list)
                 else:
                     post_input[key] = u''
-            elif path_split[0] == 'FILES':
+            elif path_split[0] in UPLOAD_PATHS:
                 # GET/POST approach for arrays does not work, because the upload is deleted.
                 del files_input[key]
             elif path_split[0] == 'DATA':
                 self.request.data = u''
+            elif path_split[0] == 'JSON':
+                json_changed = self.defuse_json(path_split) or json_changed
 
         # Update the GET data.
         self.request.args = ImmutableMultiDict(get_input)
@@ -142,6 +149,10 @@ class InputWerkzeug(Input):
         # Update the file uploads.
         self.request.files = ImmutableMultiDict(files_input)
 
+        # Update the JSON data, it is serialized only once.
+        if json_changed:
+            self.request._cached_data = json.dumps(self.json).encode('utf-8')
+
         # Don't stop the complete request.
         return True
 
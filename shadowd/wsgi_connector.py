@@ -0,0 +1,513 @@
+# Shadow Daemon -- Web Application Firewall
+#
+# Copyright (C) 2014-2022 Hendrik Buchwald <hb@zecure.org>
+#
+# This file is part of Shadow Daemon. Shadow Daemon is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import io
+import http.cookies
+import json
+import tempfile
+import urllib.parse
+import email.parser
+import email.policy
+
+from .connector import Input, Output, Connector, RoutePolicy, PendingCheck, UPLOAD_PATHS, is_json_mimetype
+
+
+def decode_native(value):
+    # Native strings of the environ contain the raw bytes of the request, the values are decoded as UTF-8.
+    return value.encode('latin-1').decode('utf-8', 'replace')
+
+def encode_native(value):
+    return value.encode('utf-8').decode('latin-1')
+
+class InputWSGI(Input):
+    def __init__(self, environ):
+        self.environ = environ
+        self.parsed = False
+
+    def get_client_ip(self):
+        return self.environ.get(self.config.get('client_ip', default='REMOTE_ADDR'))
+
+    def get_caller(self):
+        return self.environ.get(self.config.get('caller', default='PATH_INFO'))
+
+    def get_resource(self):
+        # The path is a native string that contains the raw bytes of the request, see PEP 3333.
+        path = self.environ.get('SCRIPT_NAME', '') + self.environ.get('PATH_INFO', '')
+        path = urllib.parse.quote(path.encode('latin-1'))
+        query = self.environ.get('QUERY_STRING')
+
+        if query:
+            return path + '?' + query
+
+        return path
+
+    def get_host(self):
+        return self.environ.get('HTTP_HOST')
+
+    def parse(self):
+        if self.parsed:
+            return
+
+        self.parsed = True
+
+        # Parse the query string and the cookies.
+        self.query = urllib.parse.parse_qsl(decode_native(self.environ.get('QUERY_STRING', '')), keep_blank_values=True)
+        self.cookies = {}
+
+        cookie_string = self.environ.get('HTTP_COOKIE')
+        if cookie_string:
+            cookie = http.cookies.SimpleCookie()
+            cookie.load(decode_native(cookie_string))
+
+            for key in cookie:
+                self.cookies[key] = cookie[key].value
+
+        # Buffer the body, so that it can be read again by the application.
+        spool = self.read_body()
+
+        self.form = []
+        self.parts = None
+        self.data = None
+
+        content_type = self.environ.get('CONTENT_TYPE', '')
+        mimetype = content_type.split(';')[0].strip().lower()
+
+        # Multipart bodies are parsed from the spool, so that large uploads are never read into memory.
+        if mimetype == 'multipart/form-data':
+            self.parse_multipart(spool, content_type)
+            spool.seek(0)
+            return
+
+        body = spool.read()
+        spool.seek(0)
+
+        if mimetype == 'application/x-www-form-urlencoded':
+            self.form = urllib.parse.parse_qsl(body.decode('utf-8', 'replace'), keep_blank_values=True)
+        elif body:
+            tree = None
+
+            # Parse JSON data and share the parsed tree with the application.
+            if self.json_input and is_json_mimetype(mimetype):
+                tree = self.parse_json(body)
+
+            if tree is not None:
+                self.json = tree
+                self.environ['shadowd.json'] = tree
+            else:
+                self.data = body
+
+    def create_spool(self):
+        return tempfile.SpooledTemporaryFile(
+            max_size=int(self.config.get('body_spool_size', default=1048576))
+        )
+
+    def read_body(self):
+        stream = self.environ.get('wsgi.input')
+        spool = self.create_spool()
+
+        if stream:
+            try:
+                length = int(self.environ.get('CONTENT_LENGTH') or 0)
+            except ValueError:
+                length = 0
+
+            if self.environ.get('wsgi.input_terminated'):
+                length = -1
+
+            while length:
+                chunk = stream.read(65536 if length < 0 else min(length, 65536))
+
+                if not chunk:
+                    break
+
+                spool.write(chunk)
+
+                if length > 0:
+                    length -= len(chunk)
+
+        self.environ['wsgi.input'] = spool
+        self.environ['CONTENT_LENGTH'] = str(spool.tell())
+
+        spool.flush()
+        spool.seek(0)
+
+        return spool
+
+    def get_boundary(self, content_type):
+        header = email.parser.Parser(policy=email.policy.HTTP).parsestr(
+            'Content-Type: ' + content_type + '\r\n\r\n', headersonly=True
+        )
+        boundary = header.get_param('boundary')
+
+        if not boundary:
+            return None
+
+        return boundary.encode('latin-1')
+
+    def parse_multipart(self, spool, content_type):
+        boundary = self.get_boundary(content_type)
+
+        try:
+            if not boundary:
+                raise ValueError('missing boundary')
+
+            self.preamble, self.parts = self.split_multipart(spool, b'--' + boundary)
+        except ValueError:
+            # Bodies that are not strictly valid might be parsed differently by the application,
+            # so the complete body is checked instead.
+            spool.seek(0)
+            self.data = spool.read()
+            self.parts = None
+            return
+
+        for part in self.parts:
+            if part[2] is None:
+                self.form.append((part[1], part[3].decode('utf-8', 'replace')))
+
+    def split_multipart(self, spool, delimiter):
+        # Every part is kept as [head, name, filename, payload] to be able to rewrite the body. The payload of
+        # uploads is a spooled file. Delimiters are only accepted at the start of CRLF terminated lines, any
+        # other occurrence of the delimiter is ambiguous and raises a ValueError.
+        preamble = []
+        parts = []
+        part = None
+        payload = None
+        pending = b''
+        previous = b'\r\n'
+        closed = False
+
+        for line in iter(lambda: spool.readline(65536), b''):
+            at_line_start = previous.endswith(b'\n')
+            overlap = previous[-len(delimiter):] + line
+
+            if at_line_start and line.startswith(delimiter):
+                if not previous.endswith(b'\r\n'):
+                    raise ValueError('delimiter after bare line feed')
+
+                rest = line[len(delimiter):]
+                if rest not in (b'\r\n', b'--\r\n', b'--'):
+                    raise ValueError('invalid delimiter line')
+
+                if part is not None:
+                    parts.append(self.finish_part(part, payload))
+
+                if rest.startswith(b'--'):
+                    closed = True
+                    break
+
+                part = self.read_part_head(spool, delimiter)
+                payload = io.BytesIO() if part[2] is None else self.create_spool()
+                pending = b''
+                previous = b'\r\n'
+                continue
+
+            if delimiter in overlap:
+                raise ValueError('delimiter inside of a part')
+
+            if part is None:
+                preamble.append(line)
+            else:
+                # The CRLF before the next delimiter belongs to the delimiter.
+                payload.write(pending)
+
+                if line.endswith(b'\r\n'):
+                    payload.write(line[:-2])
+                    pending = b'\r\n'
+                else:
+                    payload.write(line)
+                    pending = b''
+
+            previous = line
+
+        if not closed:
+            raise ValueError('missing closing delimiter')
+
+        # The CRLF before the first delimiter belongs to the delimiter as well.
+        preamble = b''.join(preamble)
+        if preamble and not preamble.endswith(b'\r\n'):
+            raise ValueError('invalid preamble')
+
+        return (preamble[:-2] if preamble else b'', parts)
+
+    def read_part_head(self, spool, delimiter):
+        head = []
+
+        while True:
+            line = spool.readline(65536)
+
+            if not line.endswith(b'\r\n') or delimiter in line:
+                raise ValueError('invalid part headers')
+
+            if line == b'\r\n':
+                break
+
+            head.append(line)
+
+        head = b''.join(head)[:-2]
+        headers = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(head + b'\r\n\r\n', headersonly=True)
+        name = headers.get_param('name', header='content-disposition')
+
+        # Parts that the application could decode or skip are not mapped to a path.
+        if name is None or headers.get('content-transfer-encoding'):
+            raise ValueError('unsupported part')
+
+        return [head, name, headers.get_filename(), None]
+
+    def finish_part(self, part, payload):
+        if isinstance(payload, io.BytesIO):
+            part[3] = payload.getvalue()
+        else:
+            payload.flush()
+            payload.seek(0)
+            part[3] = payload
+
+        return part
+
+    def build_multipart(self, spool):
+        delimiter = b'--' + self.get_boundary(self.environ['CONTENT_TYPE'])
+
+        if self.preamble:
+            spool.write(self.preamble + b'\r\n')
+
+        for part in self.parts:
+            spool.write(delimiter + b'\r\n' + part[0] + b'\r\n\r\n')
+
+            if isinstance(part[3], bytes):
+                spool.write(part[3])
+            else:
+                part[3].seek(0)
+
+                for chunk in iter(lambda: part[3].read(65536), b''):
+                    spool.write(chunk)
+
+                part[3].seek(0)
+
+            spool.write(b'\r\n')
+
+        spool.write(delimiter + b'--\r\n')
+
+    def group(self, pairs):
+        groups = {}
+
+        for key, value in pairs:
+            if key in groups:
+                groups[key].append(value)
+            else:
+                groups[key] = [value]
+
+        return groups
+
+    def iterate_input(self):
+        self.parse()
+
+        # Save GET and POST parameters in input.
+        for method, pairs in (('GET', self.query), ('POST', self.form)):
+            groups = self.group(pairs)
+
+            for key in groups:
+                path = method + '|' + self.escape_key(key)
+                values = groups[key]
+
+                yield from self.iterate_values(path, values)
+
+        # Save raw data in input.
+        if self.data:
+            yield ('DATA|raw', self.data.decode('utf-8', 'replace'))
+        elif self.json is not None:
+            yield from self.iterate_json(self.json)
+
+        # Save cookies in input.
+        for key in self.cookies:
+            yield from self.iterate_cookie(key, self.cookies[key])
+
+        # Save headers in input.
+        for key in self.environ:
+            if key[:5] == 'HTTP_':
+                yield from self.iterate_header(key, self.environ[key])
+
+        # Save the file names of uploads.
+        if self.parts:
+            groups = self.group((part[1], part) for part in self.parts if part[2] is not None)
+
+            for key in groups:
+                path = 'FILES|' + self.escape_key(key)
+                values = groups[key]
+
+                yield from self.iterate_values(path, [value[2] for value in values])
+                self.add_uploads(path, [value[3] for value in values])
+
+    def blank(self, pairs, key, index):
+        position = 0
+
+        for pair_index, pair in enumerate(pairs):
+            if pair[0] == key:
+                if index is None or position == index:
+                    pairs[pair_index] = (key, '')
+
+                position += 1
+
+    def defuse_input(self, threats):
+        self.parse()
+
+        body_changed = False
+
+        # Remove threats.
+        for path in threats:
+            path_split = self.split_path(path)
+
+            if len(path_split) < 2:
+                continue
+
+            key = self.unescape_key(path_split[1])
+            index = int(path_split[2]) if len(path_split) == 3 else None
+
+            if path_split[0] == 'SERVER':
+                self.environ[key] = ''
+            elif path_split[0] == 'COOKIE':
+                self.cookies[key] = ''
+            elif path_split[0] == 'GET':
+                self.blank(self.query, key, index)
+            elif path_split[0] == 'POST':
+                self.blank(self.form, key, index)
+
+                if self.parts is not None:
+                    position = 0
+
+                    for part in self.parts:
+                        if part[1] == key and part[2] is None:
+                            if index is None or position == index:
+                                part[3] = b''
+
+                            position += 1
+
+                body_changed = True
+            elif path_split[0] in UPLOAD_PATHS:
+                if self.parts is None:
+                    continue
+
+                # The upload is removed, so that it can not reach the application.
+                position = 0
+
+                for part in list(self.parts):
+                    if part[1] == key and part[2] is not None:
+                        if index is None or position == index:
+                            self.parts.remove(part)
+
+                        position += 1
+
+                body_changed = True
+            elif path_split[0] == 'DATA':
+                self.data = b''
+                body_changed = True
+            elif path_split[0] == 'JSON':
+                body_changed = self.defuse_json(path_split) or body_changed
+
+        # Generate the new environ.
+        self.environ['QUERY_STRING'] = urllib.parse.urlencode(self.query)
+
+        if self.environ.get('HTTP_COOKIE'):
+            new_cookie_string = ''
+
+            for cookie in self.cookies:
+                new_cookie_string += cookie + '=' + self.cookies[cookie] + ';'
+
+            self.environ['HTTP_COOKIE'] = encode_native(new_cookie_string)
+
+        if body_changed:
+            spool = self.create_spool()
+
+            if self.parts is not None:
+                self.build_multipart(spool)
+            elif self.json is not None:
+                spool.write(json.dumps(self.json).encode('utf-8'))
+            elif self.data is not None:
+                spool.write(self.data)
+            else:
+                spool.write(urllib.parse.urlencode(self.form).encode('utf-8'))
+
+            self.environ['CONTENT_LENGTH'] = str(spool.tell())
+            self.environ['wsgi.input'] = spool
+
+            spool.seek(0)
+
+        # Don't stop the complete request.
+        return True
+
+    def gather_hashes(self):
+        # Integrity check not supported, because everything is routed through one file.
+        self.hashes = {}
+
+class OutputWSGI(Output):
+    def error(self):
+        def application(environ, start_response):
+            start_response('500 Internal Server Error', [('Content-Type', 'text/html')])
+            return [b'<h1>500 Internal Server Error</h1>']
+
+        return application
+
+class ShadowdMiddleware:
+    def __init__(self, application, routes = (), default = 'protect'):
+        self.application = application
+        self.routes = RoutePolicy(routes, default)
+
+    def __call__(self, environ, start_response):
+        policy, options = self.routes.lookup(environ.get('PATH_INFO', ''))
+
+        # Skipped routes never parse the request.
+        if not policy == 'skip':
+            # Only safe methods run the application before the verdict is known.
+            background = policy == 'optimistic' and environ.get('REQUEST_METHOD') in ('GET', 'HEAD')
+
+            input = InputWSGI(environ)
+            status = Connector().start(
+                input,
+                OutputWSGI(),
+                observe=(True if policy == 'observe' else None),
+                profile=options.get('profile'),
+                key=options.get('key'),
+                background=background
+            )
+
+            if isinstance(status, PendingCheck):
+                # The response is buffered until the verdict is known.
+                response, body = self.buffer(environ)
+                status = status.result()
+
+                if status == True and not input.defused:
+                    start_response(*response)
+                    return body
+
+            if not status == True:
+                return status(environ, start_response)
+
+        return self.application(environ, start_response)
+
+    def buffer(self, environ):
+        response = []
+        body = []
+
+        def start_response(*args):
+            response[:] = args
+            return body.append
+
+        result = self.application(environ, start_response)
+        try:
+            body.extend(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+        return (response, body)